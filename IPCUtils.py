@@ -1,11 +1,13 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import threading
 from json import dumps
 from os import getenv
 
 import awsiot.greengrasscoreipc.client as client
 import config_utils
+import telemetry
 
 from awscrt.io import (
     ClientBootstrap,
@@ -25,7 +27,9 @@ from awsiot.greengrasscoreipc.model import (
     JsonMessage,
     GetThingShadowRequest,
     UpdateThingShadowRequest,
-    SubscribeToIoTCoreRequest
+    SubscribeToIoTCoreRequest,
+    SubscribeToConfigurationUpdateRequest,
+    ConfigurationUpdateEvents,
 )
 
 
@@ -50,41 +54,43 @@ class IPCUtils:
         connect_future.result(config_utils.TIMEOUT)
         return connection
 
-    def publish_results_to_cloud(self, PAYLOAD):
+    def publish_results_to_cloud(self, PAYLOAD, topic=None):
         r"""
         Ipc client creates a request and activates the operation to publish messages to the IoT core
         with a qos type over a topic.
 
         :param PAYLOAD: An dictionary object with inference results.
+        :param topic: Topic to publish on, config_utils.TOPIC if not given.
         """
         try:
             request = PublishToIoTCoreRequest(
-                topic_name=config_utils.TOPIC,
+                topic_name=topic or config_utils.TOPIC,
                 qos=config_utils.QOS_TYPE,
                 payload=dumps(PAYLOAD).encode(),
             )
-            operation = ipc_client.new_publish_to_iot_core()
+            operation = get_client().new_publish_to_iot_core()
             operation.activate(request).result(config_utils.TIMEOUT)
             config_utils.logger.info("Publishing results to the IoT core...")
             operation.get_response().result(config_utils.TIMEOUT)
         except Exception as e:
             config_utils.logger.error("Exception occured during publish: {}".format(e))
 
-    def publish_results_to_pubsub_ipc(self, PAYLOAD):
+    def publish_results_to_pubsub_ipc(self, PAYLOAD, topic=None):
         r"""
         Ipc client creates a request and activates the operation to publish messages to the Greengrass
         IPC Pubsub
 
         :param PAYLOAD: An dictionary object with inference results.
+        :param topic: Topic to publish on, config_utils.TOPIC if not given.
         """
         try:
             request = PublishToTopicRequest()
-            request.topic = config_utils.TOPIC
+            request.topic = topic or config_utils.TOPIC
             publish_message = PublishMessage()
             publish_message.json_message = JsonMessage()
             publish_message.json_message.message = PAYLOAD
             request.publish_message = publish_message
-            operation = ipc_client.new_publish_to_topic()
+            operation = get_client().new_publish_to_topic()
             config_utils.logger.info("Publishing results to the Greengrass IPC Pubsub...")
             operation.activate(request)
             future = operation.get_response()
@@ -92,27 +98,59 @@ class IPCUtils:
         except Exception as e:
             config_utils.logger.error("Exception occured during publish: {}".format(e))
 
-    def subscribe_to_cloud(self, topic):
+    def telemetry_publisher(self, topic=None, **kwargs):
+        r"""
+        Starts a background publisher that batches metrics into one message per interval over
+        the shared IPC client, so callers never block on IPC. See telemetry.TelemetryPublisher.
+
+        :param topic: Topic to publish on, config_utils.STATS_TOPIC if not given.
+        """
+        kwargs.setdefault("timeout", config_utils.TIMEOUT)
+        kwargs.setdefault("logger", config_utils.logger)
+        return telemetry.TelemetryPublisher(get_client(), topic or config_utils.STATS_TOPIC, **kwargs)
+
+    def subscribe_to_cloud(self, topic, on_message=None):
+        r"""
+        Subscribes to an IoT Core topic.
+
+        :param topic: Topic to subscribe to.
+        :param on_message: Called as on_message(topic, payload) for every message, on the IPC
+            event thread, so it should only hand the message over.
+        """
         config_utils.logger.info("Subscribed to Topic: {}".format(topic))
         qos = QOS.AT_LEAST_ONCE
         request = SubscribeToIoTCoreRequest()
         request.topic_name = topic
         request.qos = qos
-        handler = StreamHandler()
-        operation = ipc_client.new_subscribe_to_iot_core(handler)
+        handler = StreamHandler(on_message)
+        operation = get_client().new_subscribe_to_iot_core(handler)
         future = operation.activate(request)
         future.result(config_utils.TIMEOUT)
 
-    def get_configuration(self):
+    def subscribe_to_configuration_updates(self, on_update):
+        r"""
+        Subscribes to updates of this component's configuration.
+
+        :param on_update: Called as on_update(key_path) when a deployment changed the configuration,
+            on the IPC event thread, so it should only hand the event over; get_configuration
+            returns the new values.
+        """
+        request = SubscribeToConfigurationUpdateRequest()
+        handler = ConfigurationUpdateHandler(on_update)
+        operation = get_client().new_subscribe_to_configuration_update(handler)
+        operation.activate(request).result(config_utils.TIMEOUT)
+
+    def get_configuration(self, exit_on_error=True):
         r"""
         Ipc client creates a request and activates the operation to get the configuration of
         inference component passed in its recipe.
 
+        :param exit_on_error: Exit the program if the request fails, else raise the exception.
         :return: A dictionary object of DefaultConfiguration from the recipe.
         """
         try:
             request = GetConfigurationRequest()
-            operation = ipc_client.new_get_configuration()
+            operation = get_client().new_get_configuration()
             operation.activate(request).result(config_utils.TIMEOUT)
             result = operation.get_response().result(config_utils.TIMEOUT)
             return result.value
@@ -120,6 +158,8 @@ class IPCUtils:
             config_utils.logger.error(
                 "Exception occured during fetching the configuration: {}".format(e)
             )
+            if not exit_on_error:
+                raise
             exit(1)
     
     def sample_get_thing_shadow_request(thingName, shadowName):
@@ -130,7 +170,7 @@ class IPCUtils:
             get_thing_shadow_request.shadow_name = shadowName
             
             # retrieve the GetThingShadow response after sending the request to the IPC server
-            op = ipc_client.new_get_thing_shadow()
+            op = get_client().new_get_thing_shadow()
             op.activate(get_thing_shadow_request)
             fut = op.get_response()
             
@@ -151,7 +191,7 @@ class IPCUtils:
             update_thing_shadow_request.payload = payload
                             
             # retrieve the UpdateThingShadow response after sending the request to the IPC server
-            op = ipc_client.new_update_thing_shadow()
+            op = get_client().new_update_thing_shadow()
             op.activate(update_thing_shadow_request)
             fut = op.get_response()
             
@@ -164,17 +204,19 @@ class IPCUtils:
             )
 
 class StreamHandler(client.SubscribeToIoTCoreStreamHandler):
-    def __init__(self):
+    def __init__(self, on_message=None):
         super().__init__()
+        self.on_message = on_message
 
     def on_stream_event(self, event: IoTCoreMessage) -> None:
         try:
             message = str(event.message.payload, "utf-8")
             topic_name = event.message.topic_name
             config_utils.logger.info("Message Received: {}".format(message))
-            # Handle message.
-        except:
-            pass
+            if self.on_message is not None:
+                self.on_message(topic_name, message)
+        except Exception as e:
+            config_utils.logger.error("Exception occured while handling a message: {}".format(e))
 
     def on_stream_error(self, error: Exception) -> bool:
         # Handle error.
@@ -184,12 +226,36 @@ class StreamHandler(client.SubscribeToIoTCoreStreamHandler):
         # Handle close.
         pass
 
-# Get the ipc client
-try:
-    ipc_client = client.GreengrassCoreIPCClient(IPCUtils().connect())
-    config_utils.logger.info("Created IPC client...")
-except Exception as e:
-    config_utils.logger.error(
-        "Exception occured during the creation of an IPC client: {}".format(e)
-    )
-    exit(1)
+class ConfigurationUpdateHandler(client.SubscribeToConfigurationUpdateStreamHandler):
+    def __init__(self, on_update):
+        super().__init__()
+        self.on_update = on_update
+
+    def on_stream_event(self, event: ConfigurationUpdateEvents) -> None:
+        try:
+            self.on_update(event.configuration_update_event.key_path)
+        except Exception as e:
+            config_utils.logger.error("Exception occured while handling a configuration update: {}".format(e))
+
+    def on_stream_error(self, error: Exception) -> bool:
+        return False  # keep receiving updates
+
+    def on_stream_closed(self) -> None:
+        pass
+
+# The ipc client, connected on first use so importing this module never blocks or exits
+ipc_client = None
+ipc_client_lock = threading.Lock()
+
+
+def get_client():
+    r"""
+    Connects to the Greengrass nucleus the first time it is called and returns the one
+    ipc client every request and publisher shares. Raises if the connection fails.
+    """
+    global ipc_client
+    with ipc_client_lock:
+        if ipc_client is None:
+            ipc_client = client.GreengrassCoreIPCClient(IPCUtils().connect())
+            config_utils.logger.info("Created IPC client...")
+        return ipc_client
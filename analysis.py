@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Per-frame analysis of Harmonize Project: the average color around every light
+and its conversion to the colors streamed to the bridge.
+"""
+import time
+
+import cv2
+import numpy as np
+
+import colorconverter
+import latency
+import regions
+
+BREADTH = .30  # approx percent of the screen outside the location to capture
+CHANGE_THRESHOLD = 0  # 0-255 change of a thumbnail cell that makes the regions over it analysed again, 0 = analyse every frame (off until it saves CPU on moving content too)
+THUMB_WIDTH = 32  # columns of the change detector's thumbnail
+
+
+def light_bounds(light_locations, width, height, breadth=BREADTH, origin=(0, 0)):
+    """Maps the bridge's light locations (x, y, z in -1..1) onto a width x height picture whose
+    top left corner is at `origin` (x, y) in the frame, e.g. a --crop rectangle.
+    Returns ({light: [x, y, z] in pixels}, {light: [top, bottom, left, right]}) in light_locations order."""
+    cords = {}
+    bounds = {}
+    x0, y0 = origin
+    dist = int(breadth * (width / 2 + height / 2))  # Proportion of the pixels we want to average around in relation to the video size
+    for num, cds in light_locations.items():
+        cds = list(cds)
+        cds[0] = ((cds[0]) + 1) * width // 2 + x0  # Translates x value and resizes to video aspect ratio
+        cds[2] = (-1 * (cds[2]) + 1) * height // 2 + y0  # Flips y, translates, and resize to vid aspect ratio
+        cords[num] = cds
+        bds = [cds[2] - dist, cds[2] + dist, cds[0] - dist, cds[0] + dist]
+        limits = [(y0, y0 + height)] * 2 + [(x0, x0 + width)] * 2  # regions stay inside the picture
+        bounds[num] = [int(min(max(x, low), high)) for x, (low, high) in zip(bds, limits)]
+    return cords, bounds
+
+
+def unique_regions(bounds_lists):
+    """Merges the region lists of several outputs, regions with the same bounds are kept once.
+    Returns (unique bounds, [index into the unique bounds of every region, per output])."""
+    unique = {}
+    indexes = []
+    for bounds in bounds_lists:
+        indexes.append(np.array([unique.setdefault(tuple(b), len(unique)) for b in bounds], dtype=np.intp))
+    return [list(b) for b in unique], indexes
+
+
+class ChangeDetector:
+    """Finds the regions a frame changed, so unchanged ones need not be averaged again.
+
+    Only the `picture` (x, y, width, height, e.g. the --crop rectangle) is looked
+    at: it is sampled at 8 x 8 points per thumbnail cell of `thumb_width` columns
+    (cv2.INTER_NEAREST into a reused buffer, which reads only those pixels and
+    copies nothing) and those are averaged into the thumbnail. A region changed
+    if any cell under it moved by more than `threshold` against the reference
+    thumbnail. `commit` makes the frame the reference of the regions it changed,
+    so slow fades add up until they cross the threshold. Raw YUYV frames are
+    compared as Y0 U Y1 V macropixels, NV12 by luma only.
+    """
+
+    def __init__(self, bounds, width, height, threshold=CHANGE_THRESHOLD, raw=None, thumb_width=THUMB_WIDTH, picture=None):
+        self.width = width
+        self.height = height
+        self.raw = raw
+        self.threshold = threshold
+        px, py, pw, ph = picture or (0, 0, width, height)
+        scale = 2 if raw == "yuyv" else 1  # YUYV planes hold one macropixel per two pixels
+        self.window = (slice(py, py + ph), slice(px // scale, (px + pw) // scale))
+        plane_width = max(pw // scale, 1)
+        tw = min(thumb_width, plane_width)
+        th = max(int(round(ph * tw / plane_width)), 1)
+        self.size = (tw, th)
+        channels = {None: (3,), "yuyv": (4,), "nv12": ()}[raw]
+        self.thumb = np.empty((th, tw) + channels, dtype=np.uint8)
+        self.samples = np.empty((min(th * 8, ph), min(tw * 8, plane_width)) + channels, dtype=np.uint8)
+        self.diff = np.empty_like(self.thumb)
+        self.cell_diff = np.empty(th * tw, dtype=np.uint8)
+        self.hot = np.empty(th * tw, dtype=bool)
+        self.reference = None
+        self.pending = None
+        self.cells = np.zeros((len(bounds), th, tw), dtype=bool)  # thumbnail cells under each region
+        for cells, (top, bottom, left, right) in zip(self.cells, bounds):
+            top, bottom, left, right = top - py, bottom - py, left - px, right - px
+            r0, c0 = min(max(int(top * th / ph), 0), th - 1), min(max(int(left * tw / pw), 0), tw - 1)
+            cells[r0:max(int(np.ceil(bottom * th / ph)), r0 + 1), c0:max(int(np.ceil(right * tw / pw)), c0 + 1)] = True
+        self.cells = self.cells.reshape(len(bounds), -1)
+
+    def _plane(self, frame):
+        if self.raw == "yuyv":
+            return frame.reshape(self.height, self.width // 2, 4)
+        if self.raw == "nv12":
+            return frame.reshape(-1)[:self.width * self.height].reshape(self.height, self.width)
+        return frame
+
+    def changed(self, frame):
+        """Returns a bool per region, True if it changed since the last committed frame."""
+        samples = self.samples.shape[1::-1]
+        cv2.resize(self._plane(frame)[self.window], samples, dst=self.samples, interpolation=cv2.INTER_NEAREST)
+        cv2.resize(self.samples, self.size, dst=self.thumb, interpolation=cv2.INTER_AREA)
+        if self.reference is None:
+            self.pending = np.ones(len(self.cells), dtype=bool)
+        else:
+            diff = cv2.absdiff(self.thumb, self.reference, dst=self.diff).reshape(self.size[0] * self.size[1], -1)
+            np.max(diff, axis=1, out=self.cell_diff)
+            np.greater(self.cell_diff, self.threshold, out=self.hot)
+            self.pending = np.any(self.cells, axis=1, where=self.hot)  # regions over a changed cell, without a regions x cells temporary
+        return self.pending
+
+    def commit(self):
+        """Makes the frame last passed to `changed` the reference of the regions it changed."""
+        if self.pending is None:
+            return
+        if self.reference is None:
+            self.reference = self.thumb.copy()
+        else:
+            cells = self.cells[self.pending].any(axis=0).reshape(self.thumb.shape[:2])
+            self.reference[cells] = self.thumb[cells]
+        self.pending = None
+
+
+class FrameAnalyser:
+    """Turns frames into target colors of one or more output stages (huestream.ColorSmoother).
+
+    `outputs` lists (output, bounds, gamuts) for every output, e.g. one per
+    entertainment group. `average` takes the means of every distinct region in one
+    pass over the frame (BGR, or YUYV/NV12 with `raw`), so lights of different
+    groups at the same place are averaged once; `convert` maps each output's means
+    through its lights' gamuts, by cached lookup table unless use_lut is False,
+    writes them to the output and marks it with the frame's grab time. The two are
+    separate so the caller can drop a frame that was overwritten in between. Time
+    spent in each is recorded in `tracer`. `model` picks the region weighting
+    (regions.REGION_MODELS, uniform boxes by default) and `picture` (x, y, width,
+    height) the part of the frame the lights map to. `stride` and `budget`
+    (seconds per frame) make box regions approximate, see regions.RegionAverager.
+
+    With a `threshold` a ChangeDetector runs first: a frame in which no region
+    changed is skipped, and lights whose region did not change keep their last
+    means (only box regions on BGR frames are then averaged one by one, other
+    models still take the whole pass). Skipped frames and reused light results
+    are counted in `tracer`.
+    """
+
+    def __init__(self, outputs, width, height, raw=None, use_lut=True, tracer=None, model=None, picture=None, threshold=0,
+                 stride=1, budget=None):
+        bounds, indexes = unique_regions([b for _, b, _ in outputs])
+        if raw:  # means are taken on the raw luma/chroma planes and only they are converted to RGB
+            self.averager = regions.RAW_FORMATS[raw][1](bounds, width, height, model, picture, stride, budget)
+        else:  # one pass over the BGR frame covers every light, only the means are reordered to RGB
+            self.averager = regions.averager(bounds, model, picture, channels=[2, 1, 0], stride=stride, budget=budget)
+        self.regions = len(bounds)
+        self.bounds, self.size, self.raw, self.picture = bounds, (width, height), raw, picture
+        self.set_threshold(threshold)
+        self.last = None  # means of the last converted frame
+        self.use_lut = use_lut
+        self.tracer = tracer if tracer is not None else latency.LatencyRecorder()
+        self.averaged = 0
+
+        converters = dict()
+        self.outputs = []
+        for (output, _, gamuts), index in zip(outputs, indexes):
+            # Lights sharing a gamut are converted together
+            rows = dict()
+            for i, gamut in enumerate(gamuts):
+                rows.setdefault(gamut, []).append(i)
+            for g in rows:
+                if g not in converters:
+                    converters[g] = colorconverter.get_lut(g) if use_lut else colorconverter.Converter(g)
+                    if use_lut:
+                        converters[g].table  # build or map the table now rather than on the first frame
+            gamut_rows = [(converters[g], np.array(r)) for g, r in rows.items()]
+            self.outputs.append((output, index, gamut_rows, np.zeros((len(index), 3), dtype=np.uint8)))
+
+    def set_threshold(self, threshold):
+        """Replaces the change detector, 0 analyses every frame. The regions and tables are kept."""
+        self.threshold = threshold
+        self.detector = ChangeDetector(self.bounds, *self.size, threshold, self.raw, picture=self.picture) if threshold > 0 else None
+
+    def average(self, frame):
+        """Returns the (regions, 3) RGB means of `frame`, or None if no region changed since the last converted frame."""
+        started = time.monotonic_ns()
+        if self.detector is None:
+            means = self.averager.means(frame)
+        else:
+            changed = self.detector.changed(frame)
+            if not changed.any():  # nothing any light looks at moved, the lights keep their colors
+                self.tracer.count(latency.SKIPPED)
+                return None
+            if self.last is None or changed.all():
+                means = self.averager.means(frame)
+            else:
+                rows = np.flatnonzero(changed)
+                means = self.last.copy()
+                if hasattr(self.averager, "means_of"):
+                    means[rows] = self.averager.means_of(frame, rows)
+                else:
+                    means[rows] = self.averager.means(frame)[rows]
+                self.tracer.count(latency.REUSED, len(changed) - len(rows))
+        self.averaged = time.monotonic_ns()
+        self.tracer.record(latency.AVERAGE, started, self.averaged)
+        return means
+
+    def convert(self, means, stamp=None):
+        """Writes the light colors for `means` into every output, marked with `stamp`."""
+        for output, index, gamut_rows, rgb8 in self.outputs:
+            light_means = means[index]
+            for conv, rows in gamut_rows:
+                if self.use_lut:
+                    rgb8[rows] = conv.lookup(light_means[rows])
+                else:
+                    xy, output.target[rows] = conv.rgb_array_to_xy_and_rgb(light_means[rows], bri=1, depth=16)
+            if self.use_lut:
+                output.set_rgb8(rgb8)
+        self.tracer.record(latency.CONVERT, self.averaged)
+        self.last = means
+        if self.detector is not None:
+            self.detector.commit()
+        for output, _, _, _ in self.outputs:
+            output.mark(stamp)
+        self.tracer.count(latency.ANALYSED)
+
+
+def analyse_frames(frame_slot, prepare, notify, cancelled, timeout=1):
+    """The analysis loop: analyses every new frame of `frame_slot` (framesync.FrameSlot or a
+    shmpipeline ring) once, converts its means into the outputs and calls `notify` so the
+    senders pick them up, until `cancelled()`. `prepare(seq, frame)` returns the FrameAnalyser
+    for the frame, or None to skip it. Frames overwritten while being read, and frames published
+    while the loop was busy, are counted as dropped in the analyser's tracer."""
+    seq, analysed_seq = 0, 0
+    while not cancelled():
+        seq, frame = frame_slot.wait(seq, timeout=timeout)  # sleeps until a newer frame is published
+        if frame is None:
+            continue
+        analyser = prepare(seq, frame)
+        if analyser is None:
+            continue
+        means = analyser.average(frame)
+        if means is None:  # paused or static picture, the lights keep their colors
+            analysed_seq = seq
+            continue
+        if not frame_slot.valid(seq):  # overwritten by the capture stage while we read it
+            analyser.tracer.count(latency.DROPPED)
+            continue
+        analyser.convert(means, frame_slot.stamp_of(seq))  # the sender measures end to end latency from this frame's grab
+        notify()
+        if analysed_seq:
+            analyser.tracer.count(latency.DROPPED, seq - analysed_seq - 1)  # published while we were busy, never analysed
+        analysed_seq = seq
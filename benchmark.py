@@ -0,0 +1,375 @@
+#!/usr/bin/python3
+"""
+Offline benchmark of the Harmonize pipeline. Replays video clips or synthetic
+patterns through the same analysis (analysis.FrameAnalyser) and streaming
+(huestream.PacketSender) code as harmonize.py, with the DTLS connection replaced
+by a local UDP sink, so no capture card, bridge or TV is needed.
+
+Every combination of resolution, light count and frame format is run for
+--duration seconds and reported as one JSON object per line: capture and
+analysis frames/s, packets/s, p50/p95/p99 time per stage, CPU per core and per
+stage, and the allocations of one frame through the hot loops. With
+--sample_stride or --frame_budget_ms the error of the approximate means against
+exact ones on the same frames is reported too.
+
+    python3 benchmark.py --resolutions 1280x720,1920x1080 --lights 4,10 --output results.jsonl
+    python3 benchmark.py --video clip.mp4 --raw nv12
+    python3 benchmark.py --video clip.mp4 --sample_stride 4 --frame_budget_ms 1
+
+--verify instead checks the batch color conversion against the scalar one.
+"""
+import argparse
+import json
+import math
+import platform
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import analysis
+import colorconverter
+import cpumonitor
+import framesync
+import huestream
+import latency
+import regions
+
+PATTERNS = ("bars", "gradient", "noise", "paused", "lowmotion")
+ROW_UNIFORM = ("bars", "paused")  # every row alike, so row-strided means are exact and their error says nothing
+
+
+def pattern_frames(pattern, width, height, count):
+    """`count` BGR frames of a synthetic pattern that changes every frame, except "paused"
+    (one still picture) and "lowmotion" (a still picture with a small box moving along the bottom)."""
+    frames = []
+    x = np.arange(width, dtype=np.int32)
+    y = np.arange(height, dtype=np.int32)[:, None]
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        if pattern == "noise":
+            frames.append(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+            continue
+        if pattern in ("paused", "lowmotion"):
+            frame = pattern_frames("bars", width, height, 1)[0]
+            if pattern == "lowmotion":
+                size = max(height // 20, 2)
+                left = (i * size // 2) % (width - size)
+                frame[height - 2 * size:height - size, left:left + size] = 255
+            frames.append(frame)
+            continue
+        hsv = np.empty((height, width, 3), dtype=np.uint8)
+        if pattern == "bars":  # hue bars scrolling sideways
+            hsv[..., 0] = ((x * 8 // width) * 22 + i * 3) % 180
+        else:  # hue sweeping diagonally
+            hsv[..., 0] = ((x + y) * 180 // (width + height) + i * 2) % 180
+        hsv[..., 1] = 255
+        hsv[..., 2] = 64 + (i * 4) % 192
+        frames.append(cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR))
+    return frames
+
+
+def video_frames(path, width, height, count):
+    """Up to `count` BGR frames of a video file, scaled to width x height."""
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        sys.exit("Unable to open video {}".format(path))
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA))
+    cap.release()
+    if not frames:
+        sys.exit("No frames could be decoded from {}".format(path))
+    return frames
+
+
+def to_raw(frame, raw):
+    """Converts a BGR frame to the raw YUYV or NV12 buffer a capture device would deliver."""
+    height, width = frame.shape[:2]
+    i420 = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420).reshape(-1)
+    y = i420[:width * height].reshape(height, width)
+    u = i420[width * height:width * height * 5 // 4].reshape(height // 2, width // 2)
+    v = i420[width * height * 5 // 4:].reshape(height // 2, width // 2)
+    if raw == "nv12":
+        return np.concatenate((y.reshape(-1), np.stack((u, v), axis=2).reshape(-1)))
+    yuyv = np.empty((height, width // 2, 4), dtype=np.uint8)
+    yuyv[..., 0] = y[:, 0::2]
+    yuyv[..., 1] = np.repeat(u, 2, axis=0)
+    yuyv[..., 2] = y[:, 1::2]
+    yuyv[..., 3] = np.repeat(v, 2, axis=0)
+    return yuyv.reshape(height, width, 2)
+
+
+def ring_locations(lights):
+    """Bridge-style locations (x, y, z in -1..1) for `lights` lights around the screen."""
+    return {
+        str(i + 1): [0.8 * math.cos(2 * math.pi * i / lights), 0.0, 0.8 * math.sin(2 * math.pi * i / lights)]
+        for i in range(lights)
+    }
+
+
+class LocalSink:
+    """Stands in for dtls.DTLSTransport: sends each packet as a plain UDP datagram
+    to a socket on 127.0.0.1 that a background thread drains and counts."""
+
+    def __init__(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(("127.0.0.1", 0))
+        self.receiver.settimeout(0.2)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(self.receiver.getsockname())
+        self.received = 0
+        self.received_bytes = 0
+        self.malformed = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self._drain, name="sink", daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        while not self.stopped:
+            try:
+                data = self.receiver.recv(2048)
+            except socket.timeout:
+                continue
+            self.received += 1
+            self.received_bytes += len(data)
+            if not data.startswith(b"HueStream"):
+                self.malformed += 1
+
+    def send(self, datagram):
+        return self.sock.send(datagram)
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+        self.sock.close()
+        self.receiver.close()
+
+    def stats(self):
+        return {"received": self.received, "bytes": self.received_bytes, "malformed": self.malformed}
+
+
+class Pipeline:
+    """Capture, analysis and sender stages of harmonize.py wired to a frame list and a LocalSink."""
+
+    def __init__(self, frames, width, height, lights, args):
+        self.frames = frames
+        self.args = args
+        locations = ring_locations(lights)
+        self.packet = huestream.HueStreamPacket(locations)
+        self.output = huestream.ColorSmoother(self.packet, time_constant=args.smoothing)
+        self.scheduler = huestream.SendScheduler(self.output, rate=args.rate, keepalive=args.keepalive)
+        self.frame_slot = framesync.FrameSlot()
+        self.tracer = latency.LatencyRecorder()
+        cords, bounds = analysis.light_bounds(locations, width, height)
+        bounds = list(bounds.values())
+        self.analyser = analysis.FrameAnalyser([(self.output, bounds, [colorconverter.GamutC] * lights)],
+                                               width, height, raw=args.raw, use_lut=not args.no_lut, tracer=self.tracer,
+                                               model=args.regions, threshold=args.change_threshold,
+                                               stride=args.sample_stride, budget=args.frame_budget_ms / 1000 or None)
+        if args.raw:  # the reference for sampling_error
+            self.exact = regions.RAW_FORMATS[args.raw][1](bounds, width, height, args.regions)
+        else:
+            self.exact = regions.averager(bounds, args.regions, channels=[2, 1, 0])
+        self.sink = LocalSink()
+        self.sender = huestream.PacketSender(self.packet, self.output, self.scheduler, self.sink, self.tracer)
+        self.consumed = threading.Event()
+        self.stopped = False
+
+    def capture(self):
+        interval = 1.0 / self.args.fps if self.args.fps else 0
+        deadline = time.monotonic()
+        i = 0
+        while not self.stopped:
+            if interval:  # replay at the capture card's frame rate
+                deadline += interval
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+            else:  # as fast as the analysis stage takes them
+                self.consumed.wait(1)
+                self.consumed.clear()
+            started = time.monotonic_ns()
+            frame = self.frames[i % len(self.frames)]
+            buffer = self.frame_slot.next_buffer()  # written like cap.retrieve(image=...) would
+            if buffer is None:
+                buffer = frame.copy()
+            else:
+                np.copyto(buffer, frame)
+            grabbed = time.monotonic_ns()
+            self.tracer.record(latency.RETRIEVE, started, grabbed)
+            self.tracer.count(latency.CAPTURED)
+            self.frame_slot.publish(buffer, grabbed)
+            i += 1
+
+    def analyse(self):
+        self.consumed.set()
+        analysis.analyse_frames(self.frame_slot, self.take, self.scheduler.notify, lambda: self.stopped, timeout=0.2)
+
+    def take(self, seq, frame):
+        self.consumed.set()  # the replay may publish the next frame
+        return self.analyser
+
+    def send(self):
+        while self.sender.send_next(cancelled=lambda: self.stopped):
+            pass
+
+    def run(self, duration):
+        monitor = cpumonitor.CpuMonitor()
+        threads = []
+        for name, target in (("capture", self.capture), ("analysis", self.analyse), ("sender", self.send)):
+            t = threading.Thread(target=target, name=name)
+            t.start()
+            threads.append(t)
+            monitor.add_thread(name, t.native_id)
+        time.sleep(min(1.0, duration / 4))  # warm up before measuring
+        monitor.sample()
+        self.tracer.roll()
+        time.sleep(duration)
+        summary = self.tracer.roll()
+        cpu = monitor.sample()
+        self.stopped = True
+        self.scheduler.notify()
+        self.consumed.set()
+        for t in threads:
+            t.join()
+        self.sink.close()
+        return summary, cpu
+
+    def sampling_error(self):
+        """Absolute error (0-255 per RGB channel and light) of the analyser's means against exact
+        means over every replayed frame, at the stride the run ended with."""
+        averager = self.analyser.averager
+        stride = getattr(averager, "stride", 1)
+        errors = np.concatenate([np.abs(averager.means(f) - self.exact.means(f)).ravel() for f in self.frames])
+        return {"stride": stride, "mean": round(float(errors.mean()), 3),
+                "p99": round(float(np.percentile(errors, 99)), 3), "max": round(float(errors.max()), 3)}
+
+    def allocations(self, frames=50):
+        """Runs `frames` frames through the frame pool, analysis and packet encoding on this thread
+        under tracemalloc. Returns the peak bytes allocated within one frame and the Python blocks
+        still held afterwards."""
+        seq = self.frame_slot.seq
+
+        def one(i):
+            nonlocal seq
+            buffer = self.frame_slot.next_buffer()
+            np.copyto(buffer, self.frames[i % len(self.frames)])
+            self.frame_slot.publish(buffer)
+            seq, frame = self.frame_slot.wait(seq)
+            means = self.analyser.average(frame)
+            if means is not None:
+                self.analyser.convert(means)
+            self.output.step()
+
+        for i in range(5):
+            one(i)
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        peak = 0
+        for i in range(frames):
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            one(i)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - start)
+        held = sys.getallocatedblocks() - blocks
+        tracemalloc.stop()
+        return {"peak_bytes_per_frame": peak, "blocks_held_after_{}_frames".format(frames): held}
+
+
+def verify_batch_conversion(samples=20000, seed=1):
+    """Largest differences between the batch color conversion and the scalar methods it
+    replaces, on random colors and the corners of the RGB cube, for every gamut.
+    Returns (report, ok) with ok False if one exceeds BATCH_XY_TOLERANCE or BATCH_RGB_TOLERANCE."""
+    rng = np.random.default_rng(seed)
+    corners = np.array([[r, g, b] for r in (0, 1, 255) for g in (0, 1, 255) for b in (0, 1, 255)])
+    rgb = np.concatenate([corners, rng.integers(0, 256, size=(samples, 3))])
+    rgb = rgb[rgb.sum(axis=1) > 0]  # black has no x, y on the scalar path
+    report, ok = {}, True
+    for name, gamut in colorconverter.GAMUTS.items():
+        converter = colorconverter.Converter(gamut)
+        xy, batch_rgb = converter.rgb_array_to_xy_and_rgb(rgb.astype(np.float64))
+        scalar_xy = np.array([converter.rgb_to_xy(*(int(c) for c in row)) for row in rgb])
+        scalar_rgb = np.array([converter.xy_to_rgb(x, y) for x, y in scalar_xy])
+        xy_error = float(np.abs(xy - scalar_xy).max())
+        rgb_error = int(np.abs(batch_rgb.astype(np.int64) - scalar_rgb).max())
+        report[name] = {"xy_max_error": xy_error, "rgb_max_error": rgb_error}
+        ok = ok and xy_error <= colorconverter.BATCH_XY_TOLERANCE and rgb_error <= colorconverter.BATCH_RGB_TOLERANCE
+    return report, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the Harmonize pipeline")
+    parser.add_argument("--video", dest="video", action="append", default=[]) #clip to replay, may be repeated
+    parser.add_argument("--pattern", dest="pattern", action="append", choices=PATTERNS) #synthetic pattern, default bars (gradient with sampling) unless --video is given
+    parser.add_argument("--resolutions", dest="resolutions", default="640x480,1280x720,1920x1080")
+    parser.add_argument("--lights", dest="lights", default="1,4,10,20") #light counts to run
+    parser.add_argument("--duration", dest="duration", type=float, default=5) #measured seconds per run
+    parser.add_argument("--frames", dest="frames", type=int, default=60) #frames kept in memory and replayed in a loop
+    parser.add_argument("--fps", dest="fps", type=float, default=0) #capture rate to simulate, 0 = as fast as analysis keeps up
+    parser.add_argument("--raw", dest="raw", choices=["yuyv", "nv12"]) #replay raw YUYV/NV12 buffers instead of BGR
+    parser.add_argument("--no_lut", dest="no_lut", action="store_true")
+    parser.add_argument("--regions", dest="regions", choices=regions.REGION_MODELS, default="box")
+    parser.add_argument("--change_threshold", dest="change_threshold", type=float, default=analysis.CHANGE_THRESHOLD)
+    parser.add_argument("--sample_stride", dest="sample_stride", type=int, default=1) #average every Nth row only, 1 = exact
+    parser.add_argument("--frame_budget_ms", dest="frame_budget_ms", type=float, default=0) #adapt the stride to average a frame within this
+    parser.add_argument("--rate", dest="rate", type=float, default=50)
+    parser.add_argument("--keepalive", dest="keepalive", type=float, default=2)
+    parser.add_argument("--smoothing", dest="smoothing", type=float, default=0)
+    parser.add_argument("--output", dest="output") #append JSON lines here instead of stdout
+    parser.add_argument("--verify", dest="verify", action="store_true") #only check the batch color conversion against the scalar one, exit 1 if outside its tolerances
+    args = parser.parse_args()
+
+    if args.verify:
+        report, ok = verify_batch_conversion()
+        print(json.dumps({"batch_conversion": report, "xy_tolerance": colorconverter.BATCH_XY_TOLERANCE,
+                          "rgb_tolerance": colorconverter.BATCH_RGB_TOLERANCE, "ok": ok}))
+        sys.exit(0 if ok else 1)
+
+    sampling = args.sample_stride > 1 or args.frame_budget_ms
+    default_pattern = "gradient" if sampling else "bars"
+    sources = [("video", v) for v in args.video] + [("pattern", p) for p in (args.pattern or ([] if args.video else [default_pattern]))]
+    resolutions = [tuple(int(v) for v in r.lower().split("x")) for r in args.resolutions.split(",")]
+    light_counts = [int(n) for n in args.lights.split(",")]
+    environment = {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+                   "machine": platform.machine(), "cpus": len(cpumonitor._read_cores())}
+    out = open(args.output, "a") if args.output else sys.stdout
+
+    for kind, source in sources:
+        for width, height in resolutions:
+            if kind == "video":
+                frames = video_frames(source, width, height, args.frames)
+            else:
+                frames = pattern_frames(source, width, height, args.frames)
+            if args.raw:
+                frames = [to_raw(f, args.raw) for f in frames]
+            for lights in light_counts:
+                pipeline = Pipeline(frames, width, height, lights, args)
+                summary, cpu = pipeline.run(args.duration)
+                error = pipeline.sampling_error() if sampling and source not in ROW_UNIFORM else None
+                result = {
+                    "source": "{}:{}".format(kind, source), "width": width, "height": height, "lights": lights,
+                    "format": args.raw or "bgr", "lut": not args.no_lut, "regions": args.regions, "change_threshold": args.change_threshold,
+                    "sample_stride": args.sample_stride, "frame_budget_ms": args.frame_budget_ms, "sampling_error": error, "fps_limit": args.fps, "rate": args.rate,
+                    "smoothing": args.smoothing, "summary": summary, "cpu": cpu,
+                    "allocations": pipeline.allocations(), "snapshots": pipeline.output.snapshot.stats(), "sink": pipeline.sink.stats(), "environment": environment,
+                }
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+                print("{}:{} {}x{} {} lights: {} analysed fps, skip ratio {}, average p50 {} ms, end to end p50 {} ms, analysis CPU {}{}".format(
+                    kind, source, width, height, lights, summary["analysis_fps"], summary["skip_ratio"],
+                    summary["average"]["p50_ms"], summary["end_to_end"]["p50_ms"], cpu.get("stages", {}).get("analysis"),
+                    ", stride {stride} error mean {mean} p99 {p99} max {max}".format(**error) if error else ""), file=sys.stderr)
+    if args.output:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
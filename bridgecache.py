@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Bridge discovery and a persistent cache of the bridge, its entertainment
+groups and light topology, so restarts skip the discovery and setup requests.
+"""
+import json
+import os
+import socket
+import struct
+import tempfile
+import time
+
+import requests
+
+CACHE_FORMAT_VERSION = 2  # 2: one entry per bridge under "bridges"
+
+CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'harmonize', 'bridge.json',
+)
+
+CLOUD_DISCOVERY_URL = "https://discovery.meethue.com/"
+MDNS_GROUP = ("224.0.0.251", 5353)
+MDNS_SERVICE = "_hue._tcp.local"
+SSDP_GROUP = ("239.255.255.250", 1900)
+
+
+def load(path=CACHE_PATH):
+    """Returns the cached state, or None if there is none or it is unreadable or outdated."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get("version") != CACHE_FORMAT_VERSION:
+        return None
+    return state
+
+
+def save(state, path=CACHE_PATH):
+    """Writes `state` atomically, so a crash never leaves a half-written cache. Returns False on failure."""
+    state = dict(state, version=CACHE_FORMAT_VERSION, saved=time.time())
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        return False
+
+
+######### Discovery, each returns [{"id": bridge id, "internalipaddress": ip}] ##########
+
+def discover_cloud(timeout=3):
+    """Asks the Hue cloud endpoint for the bridges on this network."""
+    r = requests.get(CLOUD_DISCOVERY_URL, timeout=timeout)
+    r.raise_for_status()
+    return [{"id": b["id"].lower(), "internalipaddress": b["internalipaddress"]} for b in r.json()]
+
+
+def _skip_name(data, pos):
+    while True:
+        n = data[pos]
+        if n == 0:
+            return pos + 1
+        if n & 0xC0 == 0xC0:  # compression pointer ends the name
+            return pos + 2
+        pos += 1 + n
+
+
+def _txt_strings(data):
+    """Yields the strings of every TXT record in a DNS message."""
+    qdcount, ancount, nscount, arcount = struct.unpack_from("!4H", data, 4)
+    pos = 12
+    for _ in range(qdcount):
+        pos = _skip_name(data, pos) + 4
+    for _ in range(ancount + nscount + arcount):
+        pos = _skip_name(data, pos)
+        rtype, rclass, ttl, rdlength = struct.unpack_from("!HHIH", data, pos)
+        pos += 10
+        if rtype == 16:
+            i = pos
+            while i < pos + rdlength:
+                yield data[i + 1:i + 1 + data[i]].decode("utf-8", "replace")
+                i += 1 + data[i]
+        pos += rdlength
+
+
+def discover_mdns(timeout=2):
+    """Sends one mDNS PTR query for _hue._tcp.local and collects the bridges that answer.
+    The query comes from an ephemeral port, so responders answer us directly."""
+    query = struct.pack("!6H", 0, 0, 1, 0, 0, 0)
+    query += b"".join(bytes([len(p)]) + p.encode() for p in MDNS_SERVICE.split(".")) + b"\0"
+    query += struct.pack("!2H", 12, 1)  # PTR, IN
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+    bridges = {}
+    try:
+        s.sendto(query, MDNS_GROUP)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            s.settimeout(max(deadline - time.monotonic(), 0.01))
+            try:
+                data, addr = s.recvfrom(9000)
+            except socket.timeout:
+                break
+            try:
+                txt = dict(t.split("=", 1) for t in _txt_strings(data) if "=" in t)
+            except (IndexError, struct.error):
+                continue
+            if "bridgeid" in txt:
+                bridges[txt["bridgeid"].lower()] = addr[0]
+    finally:
+        s.close()
+    return [{"id": i, "internalipaddress": ip} for i, ip in bridges.items()]
+
+
+def discover_ssdp(timeout=3):
+    """Multicasts an SSDP M-SEARCH and collects the responses carrying a hue-bridgeid header."""
+    from http_parser.parser import HttpParser  # only this last fallback needs it
+    msg = \
+        'M-SEARCH * HTTP/1.1\r\n' \
+        'HOST:239.255.255.250:1900\r\n' \
+        'ST:upnp:rootdevice\r\n' \
+        'MX:2\r\n' \
+        'MAN:"ssdp:discover"\r\n' \
+        '\r\n'
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    bridges = {}
+    try:
+        s.sendto(msg.encode('utf-8'), SSDP_GROUP)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            s.settimeout(max(deadline - time.monotonic(), 0.01))
+            try:
+                data, addr = s.recvfrom(65507)
+            except socket.timeout:
+                break
+            p = HttpParser()
+            p.execute(data, len(data))
+            if p.is_headers_complete():
+                headers = p.get_headers()
+                if 'hue-bridgeid' in headers:
+                    bridges[headers['hue-bridgeid'].lower()] = addr[0]
+    finally:
+        s.close()
+    return [{"id": i, "internalipaddress": ip} for i, ip in bridges.items()]
+
+
+def discover(log=print):
+    """Finds bridges through the cloud endpoint, falling back to mDNS and then SSDP on the local network."""
+    for name, method in (("cloud", discover_cloud), ("mDNS", discover_mdns), ("SSDP", discover_ssdp)):
+        try:
+            bridges = method()
+        except (requests.RequestException, OSError, ValueError, KeyError, ImportError) as e:
+            log("{} discovery failed: {}".format(name, e))
+            continue
+        if bridges:
+            log("Found {} bridge(s) through {} discovery".format(len(bridges), name))
+            return bridges
+    return []
@@ -5,10 +5,15 @@ Based on Philips implementation guidance:
 http://www.developers.meethue.com/documentation/color-conversions-rgb-xy
 Copyright (c) 2016 Benjamin Knight / MIT License.
 """
+import hashlib
 import math
+import os
 import random
+import tempfile
 from collections import namedtuple
 
+import numpy as np
+
 __version__ = '0.5.1'
 
 # Represents a CIE 1931 XY coordinate pair.
@@ -35,6 +40,9 @@ GamutC = (
     XYPoint(0.153, 0.048),
 )
 
+# Gamut letters as reported by the bridge in capabilities.control.colorgamuttype
+GAMUTS = {'A': GamutA, 'B': GamutB, 'C': GamutC}
+
 
 def get_light_gamut(modelId):
     """Gets the correct color gamut for the provided model id.
@@ -51,6 +59,29 @@ def get_light_gamut(modelId):
     return None
 
 
+# Wide gamut D65 matrices used by ColorHelper, as arrays for the batch path.
+RGB_TO_XYZ = np.array([
+    [0.664511, 0.154324, 0.162028],
+    [0.283881, 0.668433, 0.047685],
+    [0.000088, 0.072310, 0.986039],
+])
+
+XYZ_TO_RGB = np.array([
+    [1.656492, -0.354851, -0.255038],
+    [-0.707196, 1.655397, 0.036152],
+    [0.051713, -0.121364, 1.011530],
+])
+
+# Chromaticity used by the batch path for pure black, which has no defined x, y
+# (the scalar path raises ZeroDivisionError there).
+D65_WHITE = XYPoint(0.3127, 0.3290)
+
+# The batch path matches the scalar one to within BATCH_XY_TOLERANCE on x, y and
+# BATCH_RGB_TOLERANCE on each 0-255 channel (pow rounding at int() boundaries).
+BATCH_XY_TOLERANCE = 1e-9
+BATCH_RGB_TOLERANCE = 1
+
+
 class ColorHelper:
 
     def __init__(self, gamut=GamutB):
@@ -219,6 +250,91 @@ class ColorHelper:
         # Convert the RGB values to your color object The rgb values from the above formulas are between 0.0 and 1.0.
         return (r, g, b)
 
+    def check_points_in_lamps_reach(self, xy):
+        """Vectorized `check_point_in_lamps_reach` for an (N, 2) array of x, y points."""
+        v1x, v1y = self.Lime.x - self.Red.x, self.Lime.y - self.Red.y
+        v2x, v2y = self.Blue.x - self.Red.x, self.Blue.y - self.Red.y
+        qx = xy[:, 0] - self.Red.x
+        qy = xy[:, 1] - self.Red.y
+        denominator = v1x * v2y - v1y * v2x
+        s = (qx * v2y - qy * v2x) / denominator
+        t = (v1x * qy - v1y * qx) / denominator
+
+        return (s >= 0.0) & (t >= 0.0) & (s + t <= 1.0)
+
+    def get_closest_points_to_points(self, xy):
+        """Vectorized `get_closest_point_to_point` for an (N, 2) array of x, y points."""
+        candidates = []
+        for A, B in ((self.Red, self.Lime), (self.Blue, self.Red), (self.Lime, self.Blue)):
+            APx = xy[:, 0] - A.x
+            APy = xy[:, 1] - A.y
+            ABx = B.x - A.x
+            ABy = B.y - A.y
+            t = np.clip((APx * ABx + APy * ABy) / (ABx * ABx + ABy * ABy), 0.0, 1.0)
+            candidates.append(np.stack((A.x + ABx * t, A.y + ABy * t), axis=1))
+        candidates = np.stack(candidates)
+
+        # Same edge order and tie-break as the scalar version (first lowest wins).
+        distances = np.hypot(candidates[:, :, 0] - xy[:, 0], candidates[:, :, 1] - xy[:, 1])
+        closest = np.argmin(distances, axis=0)
+        return candidates[closest, np.arange(len(xy))]
+
+    def clamp_points_to_lamps_reach(self, xy):
+        """Moves every point of an (N, 2) array outside the gamut onto its closest edge."""
+        xy = np.array(xy, dtype=np.float64).reshape(-1, 2)
+        outside = ~self.check_points_in_lamps_reach(xy)
+        if outside.any():
+            xy[outside] = self.get_closest_points_to_points(xy[outside])
+        return xy
+
+    def get_xy_points_from_rgb_array(self, rgb):
+        """Batch version of `get_xy_point_from_rgb`.
+
+        Takes an (N, 3) array of 0-255 red, green, blue values (extra columns, like the
+        fourth value of `cv2.mean`, are ignored) and returns an (N, 2) float array of
+        x, y coordinates within the lamp's gamut.
+        """
+        rgb = np.asarray(rgb, dtype=np.float64).reshape(len(rgb), -1)[:, :3] / 255.0
+        linear = np.where(rgb > 0.04045, ((rgb + 0.055) / (1.0 + 0.055)) ** 2.4, rgb / 12.92)
+
+        XYZ = linear @ RGB_TO_XYZ.T
+        total = XYZ.sum(axis=1)
+        black = total == 0
+        total[black] = 1.0
+
+        xy = XYZ[:, :2] / total[:, None]
+        xy[black] = D65_WHITE
+        return self.clamp_points_to_lamps_reach(xy)
+
+    def get_rgb_array_from_xy_and_brightness(self, xy, bri=1, depth=8):
+        """Batch version of `get_rgb_from_xy_and_brightness`.
+
+        Takes an (N, 2) array of x, y coordinates and returns an (N, 3) array of red,
+        green, blue values: uint8 0-255 by default, or uint16 0-65535 with depth=16.
+        """
+        xy = self.clamp_points_to_lamps_reach(xy)
+
+        Y = np.full(len(xy), float(bri))
+        X = (Y / xy[:, 1]) * xy[:, 0]
+        Z = (Y / xy[:, 1]) * (1 - xy[:, 0] - xy[:, 1])
+        rgb = np.stack((X, Y, Z), axis=1) @ XYZ_TO_RGB.T
+
+        # Reverse gamma; negative components take the linear branch like the scalar version.
+        rgb = np.where(
+            rgb <= 0.0031308,
+            12.92 * rgb,
+            (1.0 + 0.055) * np.power(np.maximum(rgb, 0.0031308), 1.0 / 2.4) - 0.055,
+        )
+        rgb = np.maximum(rgb, 0)
+
+        max_component = rgb.max(axis=1, keepdims=True)
+        rgb = np.where(max_component > 1, rgb / np.maximum(max_component, 1), rgb)
+
+        if depth == 16:
+            return (rgb * 65535).astype(np.uint16)
+        return (rgb * 255).astype(np.uint8)
+
+
 
 class Converter:
 
@@ -251,6 +367,27 @@ class Converter:
         r, g, b = self.color.get_rgb_from_xy_and_brightness(x, y, bri)
         return (r, g, b)
 
+    def rgb_array_to_xy(self, rgb):
+        """Converts an (N, 3) array of red, green and blue values to an (N, 2)
+        array of approximate CIE 1931 x and y coordinates.
+        """
+        return self.color.get_xy_points_from_rgb_array(rgb)
+
+    def xy_array_to_rgb(self, xy, bri=1, depth=8):
+        """Converts an (N, 2) array of CIE 1931 x and y coordinates and a brightness
+        value from 0 to 1 to an (N, 3) array of red, green and blue values
+        (uint8, or uint16 with depth=16)."""
+        return self.color.get_rgb_array_from_xy_and_brightness(xy, bri, depth)
+
+    def rgb_array_to_xy_and_rgb(self, rgb, bri=1, depth=8):
+        """Runs `rgb_to_xy` followed by `xy_to_rgb` for every row of an (N, 3) array
+        in one call. Returns the (N, 2) x, y values and the (N, 3) gamut-clamped RGB.
+        Results match the scalar methods within BATCH_XY_TOLERANCE and
+        BATCH_RGB_TOLERANCE.
+        """
+        xy = self.rgb_array_to_xy(rgb)
+        return xy, self.xy_array_to_rgb(xy, bri, depth)
+
     def get_random_xy_color(self):
         """Returns the approximate CIE 1931 x,y coordinates represented by the
         supplied hexColor parameter, or of a random color if the parameter
@@ -258,4 +395,91 @@ class Converter:
         r = self.color.random_rgb_value()
         g = self.color.random_rgb_value()
         b = self.color.random_rgb_value()
-        return self.rgb_to_xy(r, g, b)
\ No newline at end of file
+        return self.rgb_to_xy(r, g, b)
+
+
+# Bump when the table layout or the conversion feeding it changes.
+LUT_FORMAT_VERSION = 1
+
+LUT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'harmonize',
+)
+
+
+class ColorLUT:
+    """Quantized 3D lookup table for the RGB -> xy -> RGB round trip of one gamut.
+
+    The table holds `Converter.rgb_array_to_xy_and_rgb` evaluated at the center of
+    every (2**bits)^3 RGB cell, as a uint8 .npy file that is memory-mapped on load.
+    It is built lazily on first use and the file name is keyed on the gamut
+    constants, the resolution and LUT_FORMAT_VERSION, so stale tables are never
+    picked up. The Converter stays available as the exact reference path; the
+    quantization error is largest for near-black input, where hue is ill-defined.
+    """
+
+    def __init__(self, gamut=GamutB, bits=6, bri=1, cache_dir=LUT_CACHE_DIR):
+        self.gamut = gamut
+        self.bits = bits
+        self.bri = bri
+        self.cache_dir = cache_dir
+        self.shift = 8 - bits
+        self._table = None
+
+    @property
+    def path(self):
+        key = repr((LUT_FORMAT_VERSION, __version__, tuple(self.gamut), self.bits, self.bri))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'colorlut-{}-{}.npy'.format(self.bits, digest))
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = self.load()
+        return self._table
+
+    def build(self):
+        """Evaluates the reference conversion for every cell. Returns a (n, n, n, 3) uint8 array."""
+        n = 1 << self.bits
+        centers = np.arange(n) * (1 << self.shift) + ((1 << self.shift) - 1) / 2.0
+        grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1)
+        _, rgb = Converter(self.gamut).rgb_array_to_xy_and_rgb(grid.reshape(-1, 3), self.bri)
+        return rgb.reshape(n, n, n, 3)
+
+    def load(self):
+        """Memory-maps the cached table, building and saving it first if needed.
+        Falls back to an in-memory table when the cache directory is not writable."""
+        path = self.path
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+
+        table = self.build()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.npy')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, table)
+            os.replace(tmp, path)
+            return np.load(path, mmap_mode='r')
+        except OSError:
+            return table
+
+    def lookup(self, rgb):
+        """Converts an (N, 3) array of 0-255 red, green, blue values (extra columns are
+        ignored) to the (N, 3) uint8 gamut-clamped RGB with one index per row."""
+        rgb = np.asarray(rgb).reshape(len(rgb), -1)[:, :3]
+        idx = np.clip(rgb, 0, 255).astype(np.uint8) >> self.shift
+        return self.table[idx[:, 0], idx[:, 1], idx[:, 2]]
+
+
+_luts = {}
+
+
+def get_lut(gamut=GamutB, bits=6):
+    """Returns the shared ColorLUT for a gamut and resolution."""
+    key = (tuple(gamut), bits)
+    if key not in _luts:
+        _luts[key] = ColorLUT(gamut, bits)
+    return _luts[key]
@@ -2,19 +2,18 @@ from logging import INFO, StreamHandler, getLogger
 from os import environ, path
 from sys import stdout
 
-from awsiot.greengrasscoreipc.model import QOS
-
 # Set all the constants
 SCORE_THRESHOLD = 0.3
 MAX_NO_OF_RESULTS = 5
 HEIGHT = 512
 WIDTH = 512
 SHAPE = (HEIGHT, WIDTH)
-QOS_TYPE = QOS.AT_LEAST_ONCE
+QOS_TYPE = "1"  # awsiot QOS.AT_LEAST_ONCE ("1"), spelled out so importing this module does not load awsiot
 TIMEOUT = 10
 SCORE_CONVERTER = 255
 
 TOPIC = ""
+STATS_TOPIC = "harmonize/stats"  # local pubsub topic for the latency summary, overridden by "StatsTopic"
 
 # Get a logger
 logger = getLogger()
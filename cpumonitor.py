@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+CPU usage per core and per pipeline stage, and memory use, read from /proc (Linux only).
+"""
+import os
+import time
+
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _read_cores():
+    cores = []
+    with open("/proc/stat") as f:
+        for line in f:
+            if line.startswith("cpu") and line[3].isdigit():
+                values = [int(v) for v in line.split()[1:]]
+                idle = values[3] + (values[4] if len(values) > 4 else 0)
+                cores.append((sum(values[:8]), idle))
+    return cores
+
+
+def _read_task(path):
+    with open(path) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return int(fields[11]) + int(fields[12])  # utime + stime, in clock ticks
+
+
+def rss_bytes(pid="self"):
+    """Resident memory of a process."""
+    with open("/proc/{}/statm".format(pid)) as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class CpuMonitor:
+    """Reports CPU use between successive `sample` calls.
+
+    Stages are registered by name with a process id (process mode) or a thread's
+    native id within this process (thread mode). `sample` returns the busy
+    percentage of every core and of every stage, where 100 means one full core.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.last = None
+
+    def add_process(self, name, pid):
+        self.tasks[name] = "/proc/{}/stat".format(pid)
+
+    def add_thread(self, name, native_id):
+        self.tasks[name] = "/proc/{}/task/{}/stat".format(os.getpid(), native_id)
+
+    def _snapshot(self):
+        tasks = {}
+        for name, path in self.tasks.items():
+            try:
+                tasks[name] = _read_task(path)
+            except (OSError, IndexError, ValueError):
+                pass
+        return time.monotonic(), _read_cores(), tasks
+
+    def sample(self):
+        now = self._snapshot()
+        last, self.last = self.last, now
+        if last is None:
+            return None
+        elapsed = now[0] - last[0]
+        cores = []
+        for (total, idle), (last_total, last_idle) in zip(now[1], last[1]):
+            busy = (total - last_total) - (idle - last_idle)
+            cores.append(round(100.0 * busy / max(total - last_total, 1), 1))
+        tasks = {
+            name: round(100.0 * (ticks - last[2][name]) / CLK_TCK / elapsed, 1)
+            for name, ticks in now[2].items() if name in last[2]
+        }
+        return {"cores": cores, "stages": tasks}
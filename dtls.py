@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+In-process DTLS 1.2 PSK transport for the Hue Entertainment streaming port.
+Drives the system libssl through ctypes so HueStream datagrams are written as
+raw bytes on a UDP socket, without an `openssl s_client` subprocess in between.
+
+To try it without a bridge, run a local stand-in (keep its stdin open, it
+closes the session on EOF):
+    sleep 600 | openssl s_server -dtls1_2 -accept 2100 -nocert -quiet \
+        -psk 0123456789abcdef0123456789abcdef -psk_identity harmonize \
+        -cipher PSK-AES128-GCM-SHA256
+and send to it with
+    DTLSTransport("127.0.0.1", 2100, "harmonize", "0123456789abcdef0123456789abcdef").connect().send(b"HueStream...")
+"""
+import ctypes
+import ctypes.util
+import select
+import socket
+import time
+
+CIPHER = b"PSK-AES128-GCM-SHA256"
+
+# From openssl/ssl.h, openssl/bio.h and openssl/dtls1.h
+SSL_ERROR_SSL = 1
+SSL_ERROR_WANT_READ = 2
+SSL_ERROR_WANT_WRITE = 3
+SSL_ERROR_SYSCALL = 5
+SSL_ERROR_ZERO_RETURN = 6
+SSL_CTRL_SET_MIN_PROTO_VERSION = 123
+SSL_CTRL_SET_MAX_PROTO_VERSION = 124
+DTLS1_2_VERSION = 0xFEFD
+DTLS_CTRL_HANDLE_TIMEOUT = 74
+BIO_CTRL_DGRAM_SET_CONNECTED = 32
+BIO_NOCLOSE = 0
+
+PSK_CLIENT_CB = ctypes.CFUNCTYPE(
+    ctypes.c_uint,
+    ctypes.c_void_p, ctypes.c_char_p,
+    ctypes.c_void_p, ctypes.c_uint,
+    ctypes.c_void_p, ctypes.c_uint,
+)
+
+
+class DTLSError(Exception):
+    """Raised when the handshake fails or a datagram cannot be sent."""
+
+
+def _load(name, fallbacks):
+    for candidate in [ctypes.util.find_library(name)] + fallbacks:
+        if not candidate:
+            continue
+        try:
+            return ctypes.CDLL(candidate)
+        except OSError:
+            pass
+    raise DTLSError("lib{} not found, install OpenSSL 1.1 or newer".format(name))
+
+
+_libs = None
+
+
+def _libssl():
+    """Loads libssl/libcrypto once and declares the prototypes used below."""
+    global _libs
+    if _libs is not None:
+        return _libs
+    crypto = _load("crypto", ["libcrypto.so.3", "libcrypto.so.1.1", "libcrypto.so"])
+    ssl = _load("ssl", ["libssl.so.3", "libssl.so.1.1", "libssl.so"])
+    p, i, u, l = ctypes.c_void_p, ctypes.c_int, ctypes.c_uint, ctypes.c_long
+
+    def declare(lib, name, restype, *argtypes):
+        fn = getattr(lib, name)
+        fn.restype = restype
+        fn.argtypes = argtypes
+
+    declare(ssl, "DTLS_client_method", p)
+    declare(ssl, "SSL_CTX_new", p, p)
+    declare(ssl, "SSL_CTX_free", None, p)
+    declare(ssl, "SSL_CTX_ctrl", l, p, i, l, p)
+    declare(ssl, "SSL_CTX_set_cipher_list", i, p, ctypes.c_char_p)
+    declare(ssl, "SSL_CTX_set_psk_client_callback", None, p, PSK_CLIENT_CB)
+    declare(ssl, "SSL_new", p, p)
+    declare(ssl, "SSL_free", None, p)
+    declare(ssl, "SSL_set_bio", None, p, p, p)
+    declare(ssl, "SSL_connect", i, p)
+    declare(ssl, "SSL_write", i, p, p, i)
+    declare(ssl, "SSL_read", i, p, p, i)
+    declare(ssl, "SSL_shutdown", i, p)
+    declare(ssl, "SSL_get_error", i, p, i)
+    declare(ssl, "SSL_ctrl", l, p, i, l, p)
+    declare(crypto, "BIO_new_dgram", p, i, i)
+    declare(crypto, "BIO_ctrl", l, p, i, l, p)
+    declare(crypto, "BIO_ADDR_new", p)
+    declare(crypto, "BIO_ADDR_free", None, p)
+    declare(crypto, "BIO_ADDR_rawmake", i, p, i, p, ctypes.c_size_t, ctypes.c_ushort)
+    declare(crypto, "ERR_get_error", ctypes.c_ulong)
+    declare(crypto, "ERR_error_string_n", None, ctypes.c_ulong, ctypes.c_char_p, ctypes.c_size_t)
+    declare(crypto, "ERR_clear_error", None)
+    _libs = (ssl, crypto)
+    return _libs
+
+
+class DTLSTransport:
+    """One DTLS 1.2 session using PSK-AES128-GCM-SHA256 over a connected UDP socket.
+
+    `connect` performs the handshake once; `send` then encrypts and writes one
+    datagram per call. Per-send latency is kept in `send_count`, `send_time_total`,
+    `send_time_max` and `last_send_time` (seconds). Send failures, a closed
+    session or an alert from the peer raise DTLSError.
+    """
+
+    def __init__(self, host, port, identity, psk, handshake_timeout=10):
+        self.host = host
+        self.port = port
+        self.identity = identity.encode("utf-8") if isinstance(identity, str) else identity
+        self.psk = bytes.fromhex(psk) if isinstance(psk, str) else psk
+        self.handshake_timeout = handshake_timeout
+        self.sock = None
+        self.ctx = None
+        self.ssl = None
+        self.send_count = 0
+        self.send_time_total = 0.0
+        self.send_time_max = 0.0
+        self.last_send_time = 0.0
+        self._psk_cb = PSK_CLIENT_CB(self._psk_client_callback)  # keep a reference for libssl
+
+    def _psk_client_callback(self, ssl, hint, identity, max_identity_len, psk, max_psk_len):
+        if len(self.identity) + 1 > max_identity_len or len(self.psk) > max_psk_len:
+            return 0
+        ctypes.memmove(identity, self.identity + b"\0", len(self.identity) + 1)
+        ctypes.memmove(psk, self.psk, len(self.psk))
+        return len(self.psk)
+
+    def _error(self, what, ret=None):
+        ssl, crypto = _libssl()
+        reason = ""
+        if ret is not None and self.ssl:
+            reason = " (SSL_get_error={})".format(ssl.SSL_get_error(self.ssl, ret))
+        code = crypto.ERR_get_error()
+        if code:
+            buf = ctypes.create_string_buffer(256)
+            crypto.ERR_error_string_n(code, buf, len(buf))
+            reason += ": " + buf.value.decode("utf-8", "replace")
+        crypto.ERR_clear_error()
+        return DTLSError(what + reason)
+
+    def connect(self, cancelled=None):
+        """Opens the UDP socket and completes the DTLS handshake within `handshake_timeout` seconds.
+        `cancelled`, a callable polled while waiting for the bridge, aborts the handshake when it returns True."""
+        ssl, crypto = _libssl()
+        self.close()
+        crypto.ERR_clear_error()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((self.host, self.port))
+        self.sock.setblocking(False)
+
+        self.ctx = ssl.SSL_CTX_new(ssl.DTLS_client_method())
+        if not self.ctx:
+            raise self._error("SSL_CTX_new failed")
+        ssl.SSL_CTX_ctrl(self.ctx, SSL_CTRL_SET_MIN_PROTO_VERSION, DTLS1_2_VERSION, None)
+        ssl.SSL_CTX_ctrl(self.ctx, SSL_CTRL_SET_MAX_PROTO_VERSION, DTLS1_2_VERSION, None)
+        if ssl.SSL_CTX_set_cipher_list(self.ctx, CIPHER) != 1:
+            raise self._error("Cipher {} not available".format(CIPHER.decode()))
+        ssl.SSL_CTX_set_psk_client_callback(self.ctx, self._psk_cb)
+
+        self.ssl = ssl.SSL_new(self.ctx)
+        bio = crypto.BIO_new_dgram(self.sock.fileno(), BIO_NOCLOSE)
+        peer = crypto.BIO_ADDR_new()
+        host, port = self.sock.getpeername()
+        addr = socket.inet_aton(host)
+        crypto.BIO_ADDR_rawmake(peer, socket.AF_INET, addr, len(addr), socket.htons(port))
+        crypto.BIO_ctrl(bio, BIO_CTRL_DGRAM_SET_CONNECTED, 0, peer)
+        crypto.BIO_ADDR_free(peer)
+        ssl.SSL_set_bio(self.ssl, bio, bio)
+
+        deadline = time.monotonic() + self.handshake_timeout
+        while True:
+            ret = ssl.SSL_connect(self.ssl)
+            if ret == 1:
+                return self
+            err = ssl.SSL_get_error(self.ssl, ret)
+            if err not in (SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE):
+                exc = self._error("DTLS handshake with {}:{} failed".format(self.host, self.port), ret)
+                self.close()
+                raise exc
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.close()
+                raise DTLSError("DTLS handshake with {}:{} timed out".format(self.host, self.port))
+            if cancelled is not None and cancelled():
+                self.close()
+                raise DTLSError("DTLS handshake with {}:{} cancelled".format(self.host, self.port))
+            readable, _, _ = select.select([self.sock], [], [], min(remaining, 0.1))
+            if not readable:
+                ssl.SSL_ctrl(self.ssl, DTLS_CTRL_HANDLE_TIMEOUT, 0, None)  # retransmit the flight if due
+
+    def _check_incoming(self):
+        """Reads any pending records so alerts and close_notify from the peer surface as errors."""
+        ssl, _ = _libssl()
+        buf = ctypes.create_string_buffer(2048)
+        while select.select([self.sock], [], [], 0)[0]:
+            ret = ssl.SSL_read(self.ssl, buf, len(buf))
+            if ret > 0:
+                continue
+            err = ssl.SSL_get_error(self.ssl, ret)
+            if err == SSL_ERROR_WANT_READ:
+                return
+            if err == SSL_ERROR_ZERO_RETURN:
+                raise DTLSError("DTLS session closed by {}".format(self.host))
+            raise self._error("DTLS read from {} failed".format(self.host), ret)
+
+    def send(self, datagram):
+        """Encrypts and sends one datagram (bytes, bytearray or memoryview)."""
+        if self.ssl is None:
+            raise DTLSError("DTLS transport is not connected")
+        ssl, _ = _libssl()
+        self._check_incoming()
+        start = time.perf_counter()
+        if isinstance(datagram, bytes):
+            data = datagram
+        else:
+            data = (ctypes.c_char * len(datagram)).from_buffer(datagram)  # no copy for bytearray/memoryview
+        while True:
+            ret = ssl.SSL_write(self.ssl, data, len(datagram))
+            if ret > 0:
+                break
+            if ssl.SSL_get_error(self.ssl, ret) != SSL_ERROR_WANT_WRITE:
+                raise self._error("DTLS write to {} failed".format(self.host), ret)
+            select.select([], [self.sock], [], 0.01)
+        elapsed = time.perf_counter() - start
+        self.send_count += 1
+        self.send_time_total += elapsed
+        self.last_send_time = elapsed
+        if elapsed > self.send_time_max:
+            self.send_time_max = elapsed
+        return ret
+
+    def stats(self):
+        return {
+            "sends": self.send_count,
+            "send_avg_ms": 1000 * self.send_time_total / self.send_count if self.send_count else 0.0,
+            "send_max_ms": 1000 * self.send_time_max,
+            "send_last_ms": 1000 * self.last_send_time,
+        }
+
+    def close(self):
+        """Sends close_notify (best effort) and frees the session."""
+        if self.ssl:
+            ssl, crypto = _libssl()
+            ssl.SSL_shutdown(self.ssl)
+            ssl.SSL_free(self.ssl)  # also frees the BIO
+            crypto.ERR_clear_error()
+            self.ssl = None
+        if self.ctx:
+            _libssl()[0].SSL_CTX_free(self.ctx)
+            self.ctx = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc):
+        self.close()
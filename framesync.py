@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Frame handoff between the capture and analysis threads of Harmonize Project.
+"""
+import threading
+
+import numpy as np
+
+
+class FrameSlot:
+    """Single-slot, sequence-numbered handoff of the newest frame.
+
+    The producer calls `publish` for every frame it captures; consumers block in
+    `wait` until a frame newer than the one they last saw arrives, so analysis
+    runs exactly once per new frame instead of spinning on the same one.
+    Frames published while the consumer was busy are counted as skipped.
+
+    Frames live in a pool of `buffers` arrays, allocated once the first
+    published frame shows their shape. `next_buffer` hands the producer one that
+    is neither the newest frame nor the one the consumer last took, so with a
+    single consumer capture can `retrieve` into it while analysis is still
+    reading and no frame is allocated in steady state.
+    """
+
+    def __init__(self, buffers=3):
+        self.cond = threading.Condition()
+        self.buffers = []
+        self.pool_size = buffers
+        self.writing = None
+        self.published = None
+        self.taken = None
+        self.video_size = None
+        self.seq = 0
+        self.frame = None
+        self.stamp = 0
+        self.taken_stamp = 0
+        self.skipped = 0
+        self.consumed = 0
+
+    def next_buffer(self):
+        """Returns a free pool array to capture the next frame into, or None before the first frame."""
+        if not self.buffers:
+            return None
+        with self.cond:
+            busy = (self.published, self.taken)
+        self.writing = next(i for i in range(len(self.buffers)) if i not in busy)
+        return self.buffers[self.writing]
+
+    def publish(self, frame, stamp=0):
+        """Stores `frame`, grabbed at `stamp` (time.monotonic_ns()), as the newest frame and
+        wakes waiting consumers. Returns its sequence number. `frame` is normally (a view of)
+        the array from `next_buffer`; a frame of a new shape becomes the first buffer of a new
+        pool. The caller must not modify `frame` afterwards."""
+        new_pool = False
+        if self.writing is not None and np.may_share_memory(frame, self.buffers[self.writing]):
+            idx = self.writing
+        elif not self.buffers or frame.shape != self.buffers[0].shape or frame.dtype != self.buffers[0].dtype:
+            self.buffers = [frame] + [np.empty_like(frame) for _ in range(self.pool_size - 1)]
+            idx, new_pool = 0, True
+        else:
+            idx = None  # handed over by reference, outside the pool
+        self.writing = None
+        with self.cond:
+            if new_pool:
+                self.taken = None  # the consumer's frame is not part of the new pool
+            self.seq += 1
+            self.frame = frame
+            self.stamp = stamp
+            self.published = idx
+            self.cond.notify_all()
+            return self.seq
+
+    def wait(self, last_seq, timeout=None):
+        """Blocks until a frame newer than `last_seq` is available.
+        Returns (seq, frame), or (last_seq, None) if `timeout` expires first."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > last_seq, timeout):
+                return last_seq, None
+            if last_seq:
+                self.skipped += self.seq - last_seq - 1
+            self.consumed += 1
+            self.taken = self.published
+            self.taken_stamp = self.stamp
+            return self.seq, self.frame
+
+    def stamp_of(self, seq):
+        """Grab time of the frame last returned by `wait`."""
+        return self.taken_stamp
+
+    def valid(self, seq):
+        """The pool never hands out the consumer's frame for writing, so a taken frame stays intact."""
+        return True
+
+    def stats(self):
+        with self.cond:
+            return {"published": self.seq, "consumed": self.consumed,
+                    "skipped": self.skipped}
+
+
+WRITING = -1  # slot sequence number while the writer fills the slot
+
+
+class ColorSnapshot:
+    """Single-writer, single-reader double buffer of per-light colors, so the
+    analysis stage hands complete frames of colors to the sender without either
+    side ever taking a lock.
+
+    Two fixed slots hold a (lights, 3) color array and the grab time of the
+    frame it came from. A header holds the number of published snapshots and
+    each slot's sequence number (a seqlock per slot). `publish` marks the older
+    slot WRITING, fills it, stamps it with the new sequence number and only then
+    advances the published count. `read` copies the newest slot and checks that
+    the slot's sequence number is the expected one both before and after the
+    copy. If the writer began refilling the slot first, the read is counted as
+    contended; if it did so during the copy, as torn. Both are retried, up to
+    `retries` times; after that (a writer process killed mid-publish, say) the
+    reader returns the last whole snapshot it read again and counts it as stale,
+    so it always returns one whole snapshot and never spins forever.
+
+    The layout can be placed over any writable `buffer` of `nbytes(lights)`,
+    e.g. shared memory for forked stages. Across processes the check relies on
+    the writer's stores to the mapping becoming visible in program order.
+    """
+
+    HEADER = 8 * 5  # published, two slot sequence numbers, two stamps
+
+    def __init__(self, lights, buffer=None, retries=100):
+        if buffer is None:
+            buffer = bytearray(self.nbytes(lights))
+        self.header = np.ndarray((3,), dtype=np.int64, buffer=buffer)
+        self.stamps = np.ndarray((2,), dtype=np.int64, buffer=buffer, offset=24)
+        self.colors = np.ndarray((2, lights, 3), dtype=np.float64, buffer=buffer, offset=self.HEADER)
+        self.retries = retries
+        self.last = np.zeros((lights, 3))  # reader side: the last whole snapshot, (seq, stamp) in last_read
+        self.last_read = (0, 0)
+        self.torn = 0
+        self.contended = 0
+        self.stale = 0
+
+    @classmethod
+    def nbytes(cls, lights):
+        return cls.HEADER + 2 * lights * 3 * 8
+
+    @property
+    def seq(self):
+        """Number of snapshots published so far."""
+        return int(self.header[0])
+
+    def publish(self, colors, stamp=0):
+        """Writer side: makes `colors`, from the frame grabbed at `stamp`, the newest snapshot. Returns its sequence number."""
+        seq = int(self.header[0]) + 1
+        idx = seq % 2  # the slot the reader is not meant to be reading
+        self.header[1 + idx] = WRITING
+        self.colors[idx] = colors
+        self.stamps[idx] = stamp
+        self.header[1 + idx] = seq
+        self.header[0] = seq
+        return seq
+
+    def read(self, out):
+        """Reader side: copies the newest complete snapshot into `out`.
+        Returns (seq, stamp), (0, 0) before anything was published."""
+        for _ in range(self.retries):
+            seq = int(self.header[0])
+            if seq == 0:
+                return 0, 0
+            idx = seq % 2
+            if self.header[1 + idx] != seq:  # the writer lapped us and is refilling this slot
+                self.contended += 1
+                continue
+            out[:] = self.colors[idx]
+            stamp = int(self.stamps[idx])
+            if self.header[1 + idx] == seq:
+                self.last[:] = out
+                self.last_read = (seq, stamp)
+                return seq, stamp
+            self.torn += 1
+        self.stale += 1
+        out[:] = self.last
+        return self.last_read
+
+    def stats(self):
+        return {"published": self.seq, "torn": self.torn, "contended": self.contended, "stale": self.stale}
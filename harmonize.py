@@ -16,37 +16,105 @@
 ### -s # single light source optimized #
 ########################################
 
+import time
+launched = time.monotonic() #launch to first streamed packet is reported once streaming starts, imports included
 import sys
-import IPCUtils as ipc_utils
-from http_parser.parser import HttpParser
+import os
 import argparse
-import requests 
-import time
 import json
 from pathlib import Path
-from socket import socket, AF_INET, SOCK_DGRAM, IPPROTO_UDP, timeout
 import subprocess
 import threading
-import fileinput
-import numpy as np
-import cv2
-import math
-import colorconverter
-from datetime import datetime
+import signal
+import select
+import queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-import config_utils
-#ipc_utils.IPCUtils().publish_results_to_pubsub_ipc(PAYLOAD)
-
-convert = colorconverter.Converter()
 parser = argparse.ArgumentParser()
 parser.add_argument("-v","--verbose", dest="verbose", action="store_true")
-parser.add_argument("-g","--groupid", dest="groupid")
-parser.add_argument("-b","--bridgeid", dest="bridgeid")
+parser.add_argument("-g","--groupid", dest="groupid") #group id, or bridgeid:group per bridge, comma separated
+parser.add_argument("-b","--bridgeid", dest="bridgeid") #bridge id, several comma separated, or "all"
 parser.add_argument("-s","--single_light", dest="single_light", action="store_true")
-commandlineargs = parser.parse_args()
+parser.add_argument("--standalone", dest="standalone", action="store_true") #never load the Greengrass backend, even when run as a component
+parser.add_argument("--no_lut", dest="no_lut", action="store_true") #use the exact color math instead of the cached lookup tables
+parser.add_argument("--regions", dest="regions", default="box") #how each light weighs the pixels around it: box, gaussian or edge
+parser.add_argument("--change_threshold", dest="change_threshold", type=float) #skip analysing regions that changed less, 0 = analyse every frame (default)
+parser.add_argument("--breadth", dest="breadth", type=float) #share of the picture averaged around each light, default 0.3
+parser.add_argument("--frame_skip", dest="frame_skip", type=int, default=1) #analyse every Nth captured frame, 1 = every frame
+parser.add_argument("--sample_stride", dest="sample_stride", type=int, default=1) #average only every Nth pixel row, 1 = exact means
+parser.add_argument("--frame_budget_ms", dest="frame_budget_ms", type=float, default=0) #raise the row stride as needed to average a frame within this, 0 = off
+parser.add_argument("--rate", dest="rate", type=float, default=50) #max messages per second while colors change
+parser.add_argument("--keepalive", dest="keepalive", type=float, default=2) #messages per second while colors are static
+parser.add_argument("--raw", dest="raw", choices=["yuyv","nv12"]) #capture raw YUYV/NV12 and average before color conversion
+parser.add_argument("--processes", dest="processes", action="store_true") #run capture and analysis in their own processes over shared memory
+parser.add_argument("--smoothing", dest="smoothing", type=float, default=0) #seconds for lights to fade most of the way to a new color, 0 = no smoothing
+parser.add_argument("--stats_port", dest="stats_port", type=int) #serve the latency summary as text on 127.0.0.1:<port>
+parser.add_argument("--capture_size", dest="capture_size") #WIDTHxHEIGHT to request from the capture device, e.g. 640x360
+parser.add_argument("--crop", dest="crop") #X,Y,WIDTH,HEIGHT of the part of the frame the lights map to, the rest is never read
+parser.add_argument("--memory_budget", dest="memory_budget", type=float, default=256) #MB, warn at startup if the estimate exceeds it
+parser.add_argument("--import_only", dest="import_only", action="store_true") #exit right after the imports the other flags select, e.g. for python3 -X importtime
+commandlineargs = parser.parse_args() #before any heavy import, so --help and typos answer at once
+
+import_ms = {} #milliseconds per group of imports, in load order, like python3 -X importtime but coarser
+@contextmanager
+def timed_import(name):
+    started = time.perf_counter()
+    yield
+    import_ms[name] = round((time.perf_counter() - started) * 1000, 1)
+
+######### Load only what the selected mode needs ##########
+with timed_import("numpy"):
+    import numpy as np
+with timed_import("cv2"):
+    import cv2
+with timed_import("requests"):
+    import requests
+with timed_import("bridge"):
+    import hueapi
+    import bridgecache
+    import dtls
+    import huestream
+    import framesync
+with timed_import("pipeline"):
+    import colorconverter
+    import regions
+    import analysis
+    import latency
+    import supervisor
+    import cpumonitor
+    import runtimeconfig
+if commandlineargs.processes:
+    with timed_import("processes"):
+        import multiprocessing
+        import shmpipeline
+greengrass = not commandlineargs.standalone and bool(os.environ.get("AWS_GG_NUCLEUS_DOMAIN_SOCKET_FILEPATH_FOR_COMPONENT")) #set by the nucleus for its components
+if greengrass: #the IPC backend (awsiot) only when running as a Greengrass component
+    with timed_import("greengrass"):
+        import config_utils
+        import IPCUtils as ipc_utils
+if commandlineargs.import_only:
+    print("Imports: {} ({:.0f} ms in total)".format(", ".join("{} {:g} ms".format(k, v) for k, v in import_ms.items()), sum(import_ms.values())))
+    sys.exit(0)
+
+try: #what the running stages may change later, from the subscribed topic or the component configuration
+    runtime = runtimeconfig.RuntimeConfig(
+        breadth=analysis.BREADTH if commandlineargs.breadth is None else commandlineargs.breadth,
+        regions=commandlineargs.regions,
+        change_threshold=analysis.CHANGE_THRESHOLD if commandlineargs.change_threshold is None else commandlineargs.change_threshold,
+        frame_skip=commandlineargs.frame_skip, sample_stride=commandlineargs.sample_stride,
+        frame_budget_ms=commandlineargs.frame_budget_ms, rate=commandlineargs.rate, keepalive=commandlineargs.keepalive,
+        smoothing=commandlineargs.smoothing, capture_size=commandlineargs.capture_size, crop=commandlineargs.crop,
+        single_light=commandlineargs.single_light)
+except ValueError as e:
+    parser.error(e)
+settings_queue = queue.Queue() #settings messages from IPC callbacks, applied by the settings stage
 
 is_single_light = False
-stopped = False
+targets = [] #one StreamTarget per bridge, set by setup()
+running_stages = None #the Supervisor of the current run, for settings that restart or add a stage
+shutdown = supervisor.CancelToken() #cancelled by ENTER, Ctrl+C or SIGTERM, every stage stops and the program ends
+SHUTDOWN_TIMEOUT = 5 #seconds the stages get to stop before the streaming is turned off anyway
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
     
@@ -56,77 +124,95 @@ def verbose(*args, **kwargs):
 
 ######### Initialization Complete - Now lets try and connect to the bridge ##########
 
-def findhue():  #Auto-find bridges on network & get list
-    r = requests.get("https://discovery.meethue.com/")
-    bridgelist = json.loads(r.text)
-    i = 0
-    for b in bridgelist:
-        i += 1
+def bridge_choice(): #-b as a list of bridge ids, "all" streams to every bridge found
+    if commandlineargs.bridgeid is None:
+        return None
+    return [b.strip().lower() for b in commandlineargs.bridgeid.split(",")]
+
+def group_choice(bridgeid): #the -g entries for this bridge, "bridgeid:group" pins a group to one bridge
+    if commandlineargs.groupid is None:
+        return None
+    wanted = []
+    for entry in commandlineargs.groupid.split(","):
+        b, _, g = entry.strip().rpartition(":")
+        if not b or b.lower() == bridgeid:
+            wanted.append(g)
+    return wanted
+
+def pick_group(bridgeid, groups, default=None, ask=True): #a bridge streams one entertainment group at a time, returns its id or None
+    wanted = group_choice(bridgeid)
+    if wanted is not None:
+        found = [g for g in wanted if g in groups]
+        if len(found) > 1:
+            sys.exit("A bridge streams one entertainment area at a time, pick one of {} on bridge {} with -g {}:<group>".format(found, bridgeid, bridgeid))
+        return found[0] if found else None
+    if default in groups:
+        return default
+    if len(groups) == 1:
+        return next(iter(groups))
+    if not ask:
+        return None
+    eprint("Multiple entertainment groups found on bridge {} specify which with --groupid".format(bridgeid))
+    for g in groups:
+        eprint("{} = {}".format(g,groups[g]["name"]))
+    groupid = input()
+    print("You selected groupid ", groupid)
+    return groupid if groupid in groups else None
+
+def findhue():  #Auto-find bridges on network & get list, locally over mDNS/SSDP if the cloud endpoint is unreachable
+    bridgelist = bridgecache.discover(verbose)
+    if not bridgelist:
+        return []
     
-    if commandlineargs.bridgeid is not None:
-        found = False
-        for idx, b in enumerate(bridgelist):
-            if b["id"] == commandlineargs.bridgeid:
-                bridge = idx
-                found = True
-                break
-        if not found:
-            sys.exit("bridge {} was not found".format(commandlineargs.bridgeid))
+    wanted = bridge_choice()
+    if wanted == ["all"]:
+        chosen = bridgelist
+    elif wanted is not None:
+        found = [b["id"] for b in bridgelist]
+        for bridgeid in wanted:
+            if bridgeid not in found:
+                sys.exit("bridge {} was not found".format(bridgeid))
+        chosen = [b for b in bridgelist if b["id"] in wanted]
     elif len(bridgelist)>1:
-        print("Multiple bridges found. Select one of the bridges below (", list(bridgelist),")")
-        bridge = int(input())   
+        print("Multiple bridges found. Select one or more (comma separated) of the bridges below (", list(bridgelist),")")
+        chosen = [bridgelist[int(i)] for i in input().split(",")]
     else: 
-        bridge = 0 #Default to the only bridge if only one is found
+        chosen = bridgelist #Default to the only bridge if only one is found
      
-    hueip = bridgelist[bridge]['internalipaddress'] #Logic currently assumes 1 bridge on the network
-    print("I will use the bridge at ", hueip)
-    
-    msg = \
-        'M-SEARCH * HTTP/1.1\r\n' \
-        'HOST:' + hueip +':1900\r\n' \
-        'ST:upnp:rootdevice\r\n' \
-        'MX:2\r\n' \
-        'MAN:"ssdp:discover"\r\n' \
-        '\r\n'
-    s = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP)
-    s.settimeout(12)
-    s.sendto(msg.encode('utf-8'), (hueip, 1900) )
-    try:
-        while True:
-            data, addr = s.recvfrom(65507)
-            p = HttpParser()
-            recved = len(data)
-            nparsed = p.execute(data, recved)
-            assert nparsed == recved
-            if p.is_headers_complete():
-                headers = p.get_headers()
-                if 'hue-bridgeid' in headers:
-                    return addr,headers
-            if p.is_message_complete():
-                break
-    except timeout:
-        verbose('Timed out, better luck next time')
-        pass
-    return None
-
-def register():
-    print("Device not registered on bridge")
+    for b in chosen:
+        print("I will use the bridge at ", b['internalipaddress'])
+    return [(b['internalipaddress'], b["id"]) for b in chosen]
+
+def load_clients(): #client.json maps each bridge id to the username and client key registered on it
+    global clients
+    clients = {}
+    if Path("./client.json").is_file():
+        with open("client.json", "r") as f:
+            data = json.load(f)
+        clients = {"": data} if "username" in data else data #files from before multiple bridges hold one bridge's keys
+
+def save_client(bridgeid, clientdata):
+    if clients.get("") is clientdata: #the keys of an older file turned out to belong to this bridge
+        del clients[""]
+    clients[bridgeid] = clientdata
+    with open("client.json", "w") as f:
+        f.write(json.dumps(clients))
+
+def register(bridge, bridgeid):
+    print("Device not registered on bridge", bridgeid)
     payload = {"devicetype":"harmonizehue","generateclientkey":True}
     print("You have 45 seconds to push the button! I will check if you did every 5 seconds")
     attempts = 1
     while attempts < 10:
-        r = requests.post(("http://%s/api" % (hueip)), json.dumps(payload))
-        bridgeresponse = json.loads(r.text)
+        bridgeresponse = bridge.post("", payload, auth=False)
         if  'error' in bridgeresponse[0]:
             print(attempts,"Warning: {0}".format(bridgeresponse[0]['error']['description']))
         elif('success') in bridgeresponse[0]:
             clientdata = bridgeresponse[0]["success"]
-            did_get_username = True
-            f = open("client.json", "w")
-            f.write(json.dumps(clientdata))
-            f.close()
+            save_client(bridgeid, clientdata)
+            bridge.username = clientdata['username']
             print("Success! I generated a username and client key to access the bridge's Entertainment API!")
-            break
+            return clientdata
         else:
             print("No response")
         attempts += 1
@@ -135,197 +221,294 @@ def register():
         print("You didn't push the button...  Exiting...")
         exit()
 
-def enablestreaming():
+def enablestreaming(target):
     ##### Setting up streaming service and calling the DTLS handshake command ######
-    print("Enabling streaming on your Entertainment area") #Allows us to send UPD to port 2100
-    r = requests.put(url = baseurl+"/{}/groups/{}".format(clientdata['username'],groupid),json={"stream":{"active":True}})
-    jsondata = r.json()
+    print("Enabling streaming on your Entertainment area", target.name) #Allows us to send UPD to port 2100
+    jsondata = target.bridge.put("groups/{}".format(target.groupid), {"stream":{"active":True}})
+
+def light_gamut(light): #each light's color gamut decides which conversion table it uses
+    try:
+        return colorconverter.get_light_gamut(light.get('modelid'))
+    except ValueError:
+        gamuttype = light.get('capabilities', {}).get('control', {}).get('colorgamuttype')
+        return colorconverter.GAMUTS.get(gamuttype, colorconverter.GamutB)
+
+def stream_target(bridge, bridgeid, groupid, clientdata, light_locations, light_gamuts):
+    return huestream.StreamTarget(bridge, bridgeid, groupid, clientdata['clientkey'], light_locations, light_gamuts,
+                                  time_constant=runtime["smoothing"], #fades between analysis results at the send rate
+                                  rate=runtime["rate"], keepalive=runtime["keepalive"])
+
+def save_topology(bridgeid, hueip, config, groups, lights, target): #what the next start needs to skip discovery and setup requests
+    topology[bridgeid] = {
+        "ip": hueip,
+        "apiversion": config["apiversion"],
+        "username": target.bridge.username,
+        "groupid": target.groupid,
+        "groups": {k: {"name": g["name"], "lights": g.get("lights", [])} for k, g in groups.items() if g["type"]=="Entertainment"},
+        "locations": target.light_locations,
+        "lights": {k: {"modelid": l.get("modelid"), "capabilities": {"control": {
+            "colorgamuttype": l.get('capabilities', {}).get('control', {}).get('colorgamuttype')}}} for k, l in lights.items()},
+    }
+    bridgecache.save({"bridges": topology})
+
+def refresh_topology(): #runs in the background after a cached start so the next start sees changes
+    for target in targets:
+        try:
+            config, groups, lights = target.bridge.fetch("config", "groups", "lights")
+            save_topology(target.bridgeid, target.bridge.ip, config, groups, lights, target)
+            verbose("Bridge cache refreshed for", target.bridgeid)
+        except Exception as e:
+            verbose("Refreshing the bridge cache failed: ", e)
+
+def cached_target(bridgeid, entry, clientdata, groupid): #answers only if the bridge is still at this address, knows our username and still has the group
+    bridge = hueapi.BridgeClient(entry["ip"], clientdata['username'])
+    try:
+        jsondata = bridge.get("groups/{}".format(groupid), timeout=2)
+    except (requests.RequestException, ValueError) as e:
+        verbose("Cached bridge at {} did not answer: {}".format(entry["ip"], e))
+        return None
+    if not isinstance(jsondata, dict) or 'locations' not in jsondata:
+        verbose("Cached bridge data no longer valid: ", jsondata)
+        return None
+    light_locations = jsondata['locations'] #fresh from the validating request
+    light_gamuts = {l: light_gamut(entry["lights"].get(l, {})) for l in light_locations}
+    verbose("Using the cached bridge {} at {}, group {} (api version {})".format(bridgeid, entry["ip"], groupid, entry["apiversion"]))
+    verbose("These are the lights and locations found: \n", light_locations)
+    return stream_target(bridge, bridgeid, groupid, clientdata, light_locations, light_gamuts)
+
+def cached_setup(): #reuses the bridges, groups and light locations of the last run after one validating request per bridge
+    global targets, topology
+    state = bridgecache.load()
+    if state is None or not state.get("bridges"):
+        return False
+    wanted = bridge_choice()
+    if wanted is not None and wanted != ["all"] and sorted(wanted) != sorted(state["bridges"]):
+        return False
+    chosen = []
+    for bridgeid, entry in state["bridges"].items():
+        clientdata = clients.get(bridgeid) or clients.get("")
+        if clientdata is None or entry.get("username") != clientdata.get('username'):
+            return False
+        groupid = pick_group(bridgeid, entry["groups"], default=entry["groupid"], ask=False)
+        if groupid is None:
+            return False
+        chosen.append((bridgeid, entry, clientdata, groupid))
+    with ThreadPoolExecutor(max_workers=len(chosen)) as pool: #the bridges are checked at once
+        cached = list(pool.map(lambda c: cached_target(*c), chosen))
+    if None in cached:
+        return False
+    targets = cached
+    topology = state["bridges"]
+    return True
 
 def setup():
-    global light_locations, clientdata, hueip, groupid, bufferlock
+    global from_cache, frame_slot, tracer
+    load_clients()
+    from_cache = cached_setup()
+    if not from_cache:
+        discover_and_setup()
+
+    frame_slot = framesync.FrameSlot() #hands each captured frame to the averager exactly once
+    tracer = latency.LatencyRecorder(shared=commandlineargs.processes) #per-stage latency histograms, shared with forked stages
+
+def discover_and_setup():
+    global targets, topology
     #verbose("Finding bridge...")
-    (hueip,port),headers = findhue() or ((None,None),None)
-    if hueip is None:
+    bridges = findhue()
+    if not bridges:
         sys.exit("Hue bridge not found. Mission failed, better luck next time")
+    topology = {}
+    targets = [setup_bridge(hueip, bridgeid) for hueip, bridgeid in bridges] #one after another, registering may need a button press on each
+
+def setup_bridge(hueip, bridgeid): #registers on the bridge if needed and returns the StreamTarget of its entertainment group
     verbose("I found the Bridge on", hueip)
     verbose("Checking if Harmonize is registered on the bridge... (Looking for client.json)") #Check if the username and client key have already been saved
 
-    if Path("./client.json").is_file():
-        f = open("client.json", "r")
-        jsonstr = f.read()
-        clientdata = json.loads(jsonstr)
-        f.close()
+    bridge = hueapi.BridgeClient(hueip) #one pooled connection for every request of this session
+    allgroups = None
+    clientdata = clients.get(bridgeid) or clients.get("")
+    if clientdata:
         verbose("Client Data Found)")
-        global baseurl
-        baseurl = "http://{}/api".format(hueip)
-        setupurl = baseurl + "/" + clientdata['username']
-        r = requests.get(url = setupurl)
-        setupresponse = dict()
-        setupresponse = json.loads(r.text)
-        if  setupresponse.get('error'):
-            verbose("Client data no longer valid")
-            register()
+        bridge.username = clientdata['username']
+        verbose("Requesting bridge information...")
+        config, allgroups, lights = bridge.fetch("config", "groups", "lights") #independent, so fetched at once
+        if hueapi.error_of(allgroups):
+            verbose("Client data no longer valid: ", hueapi.error_of(allgroups))
+            allgroups = None
+            clientdata = register(bridge, bridgeid)
         else:
             verbose("Client data valid", clientdata)
+            if bridgeid not in clients:
+                save_client(bridgeid, clientdata)
     else:
-        register()
+        clientdata = register(bridge, bridgeid)
+    if allgroups is None: #registered just now
+        config, allgroups, lights = bridge.fetch("config", "groups", "lights", refresh=True)
 
-    verbose("Requesting bridge information...") #Make sure bridge supports streaming API
-    r = requests.get(url = baseurl+"/config")
-    jsondata = r.json()
+    jsondata = config #Make sure bridge supports streaming API
     if jsondata["apiversion"]<"1.22":
         sys.exit("Bridge is way too old! Upgrade it to 1.22+ in the Hue app.")
     verbose("Api version is good to go. You've got version {}...".format(jsondata["apiversion"]))
 
     ######### We're connected! - Now lets find entertainment areas in the list of groups ##########
-    r = requests.get(url = baseurl+"/{}/groups".format(clientdata['username']))
-    jsondata = r.json()
-    groups = dict()
-    groupid = commandlineargs.groupid
-
-    if groupid is not None:
-        verbose("Checking for entertainment group {}".format(groupid))
-    else:
-        verbose("Checking for entertainment groups (not none)")
-
-    for k in jsondata:  #These 3 sections isolate Entertainment areas from normal groups (like rooms)
-        if jsondata[k]["type"]=="Entertainment":
-            if groupid is None or k==groupid:
-                groups[k] = jsondata[k]
-
-    if len(groups)==0: #No groups or null = exit
-        if groupid is not None:
-            sys.exit("Entertainment group not found, set one up in the Hue App according to the instructions on github.")
-        else:
-            sys.exit("Entertainment group not found, set one up in the Hue App according to the instructions on github.")
-
-    if len(groups)>1:
-        eprint("Multiple entertainment groups found (", groups,") specify which with --groupid")
-        for g in groups:
-            eprint("{} = {}".format(g,groups[g]["name"]))
-        groupid = input()
-        print("You selected groupid ", groupid)
-        #sys.exit()
-
-    if groupid is None:
-        groupid=next(iter(groups))
-    verbose("Using groupid={}".format(groupid))
+    groups = {k: g for k, g in allgroups.items() if g["type"]=="Entertainment"} #isolate Entertainment areas from normal groups (like rooms)
+    groupid = pick_group(bridgeid, groups)
+    if groupid is None: #No groups or null = exit
+        sys.exit("Entertainment group not found, set one up in the Hue App according to the instructions on github.")
+    verbose("Using groupid={} on bridge {}".format(groupid, bridgeid))
 
     #### Lets get the lights & their locations in our selected group and enable streaming ######
-    for l in jsondata:
-        r = requests.get(url = baseurl+"/{}/groups/{}".format(clientdata['username'],groupid))
-        jsondata = r.json()
-        light_locations = dict()
-        light_locations = jsondata['locations']
+    light_locations = allgroups[groupid]['locations'] #the group list already carries every entertainment area's locations
     verbose("These are the lights and locations found: \n", light_locations)
 
-    enablestreaming()
-
-    ######### Prepare the messages' vessel for the RGB values we will insert
-    bufferlock = threading.Lock()
-    stopped = False
-    def stdin_to_buffer():
-        for line in fileinput.input():
-            print(line)
-            if stopped:
-                break
-
-######This is used to execute the command near the bottom of this document to create the DTLS handshake with the bridge on port 2100
-def execute(cmd):
-    popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-    verbose("Executing send commands... Cross your fingers")
-    for stdout_line in iter(popen.stdout.readline, ""):
-        yield stdout_line
-    popen.stdout.close()
-    return_code = popen.wait()
-    if return_code:
-        raise subprocess.CalledProcessError(return_code, cmd)
+    #### Each light's color gamut decides which conversion table it uses ######
+    light_gamuts = {l: light_gamut(lights.get(l, {})) for l in light_locations}
+    verbose("Light gamuts: ", light_gamuts)
+    target = stream_target(bridge, bridgeid, groupid, clientdata, light_locations, light_gamuts)
+    save_topology(bridgeid, hueip, config, allgroups, lights, target)
+    return target
 
 ######################################################
 ### Scaling light locations and averaging colors #####
 ######################################################
 
-def averageimage():
+ANALYSER_SETTINGS = ("breadth", "regions", "crop", "sample_stride", "frame_budget_ms") #changing one rebuilds the regions, change_threshold only replaces the change detector
+
+def sampling(settings): #the averagers' row stride and time budget in seconds
+    return settings["sample_stride"], settings["frame_budget_ms"] / 1000 or None
+
+def build_analyser(settings):
 ########## Scales up locations to identify the nearest pixel based on lights' locations #######
-    time.sleep(1.2) #wait for video size to be defined
-    for x, coords in light_locations.items():
-        coords[0] = ((coords[0])+1) * w//2 #Translates x value and resizes to video aspect ratio
-        coords[2] = (-1*(coords[2])+1) * h//2 #Flips y, translates, and resize to vid aspect ratio
-        
-    #for x, y in light_locations.items(): #Defines locations by light
-        #time.sleep(.01)
-    scaled_locations = list(light_locations.items()) #Makes it a list of locations by light
-    verbose("Lights and locations (in order) on TV array after math are: ", scaled_locations)
-  
-#### This section assigns light locations to variable light1,2,3...etc. in JSON order
-    avgsize = w/2 + h/2
-    verbose('avgsize is', avgsize)
-    breadth = .30 #approx percent of the screen outside the location to capture
-    dist = int(breadth*avgsize) #Proportion of the pixels we want to average around in relation to the video size
-    verbose('Distance from relative location is: ', dist)
-
-    global cords #array of coordinates
-    global bounds #array of bounds for each coord, each item is formatted as [top, bottom, left, right]
-    
-    #initialize the arrays
-    cords = {}
-    bounds = {}
-    for num, cds in scaled_locations:
-        #cords.append(cds)
-        cords[num] = cds
-        bds = [cds[2] - dist, cds[2] + dist, cds[0] - dist, cds[0] + dist]
-        bds = list(map(int, bds))
-        bds = list(map(lambda x: 0 if x < 0 else x, bds))
-        #bounds.append(bds)
-        bounds[num] = bds
-   
-    global rgb,rgb_bytes #array of rgb values, one for each light
-    rgb = {}
-    rgb_bytes = {}
-    area = {}
-
-# Constantly sets RGB values by location via taking average of nearby pixels
-    while not stopped:
-        for x, bds in bounds.items():
-            #area[x] = rgbframe[bds[2]:bds[3], bds[0]:bds[1], :]
-            area[x] = rgbframe[bds[0]:bds[1], bds[2]:bds[3], :]
-            rgb[x] = cv2.mean(area[x])
-        for x, c in rgb.items():
-            xy = convert.rgb_to_xy(c[0],c[1],c[2])
-            rgb_with_brightness = convert.xy_to_rgb(xy[0],xy[1],bri=1)
-            #rgb_with_brightness = bytes.fromhex(convert.xy_to_hex(xy[0],xy[1],bri=.5))
-            rgb_bytes[x] = bytearray([int(rgb_with_brightness[0]/2), int(rgb_with_brightness[0]/2), int(rgb_with_brightness[1]/2), int(rgb_with_brightness[1]/2), int(rgb_with_brightness[2]/2), int(rgb_with_brightness[2]/2),] )
+    cx, cy, cw, ch = crop_rect(w, h, settings["crop"])
+    outputs = []
+    for output, _, light_locations, light_gamuts in sinks:
+        cords, bounds = analysis.light_bounds(light_locations, cw, ch, breadth=settings["breadth"], origin=(cx, cy)) #scales up locations to the video (or --crop) size, in JSON order
+        verbose("Lights and locations (in order) on TV array after math are: ", list(cords.items()))
+        verbose('Bounds around each light are: ', bounds) #each item is formatted as [top, bottom, left, right]
+        outputs.append((output, [bounds[x] for x in bounds], [light_gamuts.get(x, colorconverter.GamutB) for x in bounds]))
+    analyser = analysis.FrameAnalyser(outputs, w, h, raw=commandlineargs.raw, use_lut=not commandlineargs.no_lut, tracer=tracer,
+                                      model=settings["regions"], picture=(cx, cy, cw, ch), threshold=settings["change_threshold"],
+                                      stride=settings["sample_stride"], budget=sampling(settings)[1]) #the color tables are cached, only the regions are new
+    verbose("{} lights share {} regions".format(sum(len(o[1]) for o in outputs), analyser.regions))
+    return analyser
+
+def averageimage(token):
+# Constantly sets RGB values by location via taking average of nearby pixels, once per distinct region of all groups
+    version, settings, analyser, size = None, None, None, None
+    def prepare(seq, frame): #the analyser for this frame, rebuilding only what new settings or a new capture size affect
+        nonlocal version, settings, analyser, size
+        if runtime.version != version or (w, h) != size:
+            version, changed = runtime.snapshot
+            if analyser is None or (w, h) != size or any(changed[k] != settings[k] for k in ANALYSER_SETTINGS):
+                analyser, size = build_analyser(changed), (w, h) #w and h are set by the capture thread before its first frame
+            elif changed["change_threshold"] != settings["change_threshold"]:
+                analyser.set_threshold(changed["change_threshold"])
+            settings = changed
+        if frame.nbytes != int(w * h * regions.FRAME_BYTES_PER_PIXEL[commandlineargs.raw]): #from before the capture size changed
+            return None
+        if seq % 1000 == 0:
+            verbose("Frame handoff: ", frame_slot.stats())
+        return analyser
+    def notify():
+        for _, scheduler, _, _ in sinks:
+            scheduler.notify()
+    analysis.analyse_frames(frame_slot, prepare, notify, lambda: token.cancelled)
 
 ######################################################
 ############ Video Capture Setup #####################
 ######################################################
 
 ######### Now that weve defined our RGB values as bytes, we define how we pull values from the video analyzer output
-def cv2input_to_buffer(): ######### Section opens the device, sets buffer, pulls W/H
-    global w,h,rgbframe, channels
+def crop_rect(w, h, crop=None): #--crop (or the crop setting) as (x, y, width, height) within a w x h frame, the whole frame by default
+    crop = runtime["crop"] if crop is None else crop
+    if not crop:
+        return 0, 0, w, h
+    x, y, cw, ch = [int(v) for v in crop.split(",")]
+    x, y = min(max(x, 0), w - 1), min(max(y, 0), h - 1)
+    return x, y, min(cw, w - x), min(ch, h - y)
+
+def report_memory(w, h):
+    buffers = 1 if is_single_light else 3 #frame pool (thread mode) or shared memory ring (--processes)
+    frame_bytes = int(w * h * regions.FRAME_BYTES_PER_PIXEL[commandlineargs.raw])
+    table_bytes = 0 if is_single_light and not commandlineargs.raw else regions.table_bytes(w, h, commandlineargs.raw)
+    lut_bytes = 0 if commandlineargs.no_lut else len(set(g for t in targets for g in t.light_gamuts.values())) * 3 * (1 << 6) ** 3
+    estimate = buffers * frame_bytes + table_bytes + lut_bytes
+    rss = cpumonitor.rss_bytes()
+    mb = 1024 * 1024
+    print("Memory: {} frame buffers of {:.1f} MB, summed-area table {:.1f} MB, color tables {:.1f} MB = {:.1f} MB for frames, process resident {:.1f} MB".format(
+        buffers, frame_bytes / mb, table_bytes / mb, lut_bytes / mb, estimate / mb, rss / mb))
+    if estimate + rss > commandlineargs.memory_budget * mb:
+        eprint("Warning: about {:.0f} MB needed, over the {:.0f} MB budget. Try a smaller --capture_size, --raw nv12 or --crop".format(
+            (estimate + rss) / mb, commandlineargs.memory_budget))
+
+def cv2input_to_buffer(token): ######### Section opens the device, sets buffer, pulls W/H
     cap = cv2.VideoCapture(1, cv2.CAP_V4L2) #variable cap is our raw video input. This is specific to a jetson that also has a camera installed on video0
+    try:
+        capture_frames(cap, token)
+    finally:
+        cap.release() #the supervisor reopens the device when the stage restarts
+
+def capture_frames(cap, token):
+    global w,h, channels
     if cap.isOpened(): # Try to get the first frame
         verbose('Capture Device Opened')
     else: #Makes sure we can access the device
-        sys.exit('Unable to open Capture Device') #quit
+        raise RuntimeError('Unable to open Capture Device')
+    if commandlineargs.raw: #skip OpenCV's full-frame decode and hand the device's YUYV/NV12 buffers through as they are
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*regions.RAW_FORMATS[commandlineargs.raw][0]))
+        cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    if runtime["capture_size"]: #let the device scale down instead of us reading pixels we average away
+        width, height = [int(v) for v in runtime["capture_size"].split("x")]
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
     w  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))  # gets video width
     h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) # gets video height
+    frame_slot.video_size = (w, h)
+    runtime.frame_size = (w, h) #a crop change that does not fit is refused
     verbose('Video Shape is: ', w, h) #prints video shape
+    report_memory(w, h)
 
 ########## This section loops & pulls re-colored frames and alwyas get the newest frame 
     cap.set(cv2.CAP_PROP_BUFFERSIZE,1) # No frame buffer to avoid lagging, always grab newest frame
+    version = None
+    bgrframe = None
     ct = 0 ######ct code grabs every X frame as indicated below
-    while not stopped:
+    while not token.cancelled:
+        if runtime.version != version: #crop and frame skip may change while we run, a new capture size restarts this stage
+            version, settings = runtime.snapshot
+            cx, cy, cw, ch = crop_rect(w, h, settings["crop"])
+            skip = settings["frame_skip"]
+            if commandlineargs.raw:
+                full_frame = regions.RAW_FORMATS[commandlineargs.raw][1]([[cy, cy + ch, cx, cx + cw]], w, h, None, None, *sampling(settings))
+            elif sampling(settings) != (1, None): #approximate, cv2.mean stays the exact path
+                full_frame = regions.RegionAverager([[cy, cy + ch, cx, cx + cw]], [2, 1, 0], *sampling(settings))
+            else:
+                full_frame = None
         ct += 1
-        ret = cap.grab() #constantly grabs frames
-        if ct % 1 == 0: # Skip frames (1=don't skip,2=skip half,3=skip 2/3rds)
-            ret, bgrframe = cap.retrieve() #processes most recent frame
+        started = time.monotonic_ns()
+        ret = cap.grab() #blocks until the device delivers the next frame
+        if not ret: raise RuntimeError("Capture device stopped delivering frames")
+        grabbed = time.monotonic_ns() #latency of everything downstream is measured from here
+        tracer.record(latency.GRAB, started, grabbed)
+        if ct % skip == 0: # Skip frames (1=don't skip,2=skip half,3=skip 2/3rds)
+            buffer = bgrframe if is_single_light else frame_slot.next_buffer() #a free pooled buffer (shared memory in --processes mode), the single light mode reuses its one frame
+            ret, bgrframe = cap.retrieve(buffer) #processes most recent frame, written in place so no frame is allocated
+            if not ret: raise RuntimeError("Capture device stopped delivering frames")
+            tracer.record(latency.RETRIEVE, grabbed)
+            tracer.count(latency.CAPTURED)
             if is_single_light:
-                channels = cv2.mean(bgrframe)
+                if full_frame is not None:
+                    rgb = full_frame.means(bgrframe)
+                else:
+                    channels = cv2.mean(bgrframe[cy:cy + ch, cx:cx + cw])
+                    rgb = [channels[2::-1]] # channels corrected here from BGR to RGB
+                for output, scheduler, _, _ in sinks: #every group's light gets the same color
+                    output.set_rgb8(rgb)
+                    output.mark(grabbed)
+                    scheduler.notify()
+                tracer.count(latency.ANALYSED)
             else:
-                rgbframe = cv2.cvtColor(bgrframe, cv2.COLOR_BGR2RGB) #corrects BGR to RGB
-                #verbose('BGrframe is :',bgrframe)
-            if not ret: break
+                frame_slot.publish(bgrframe, grabbed) #wakes the averager once per new frame; BGR, or still YUYV/NV12 with --raw and the averager decodes only the region means
 
 def set_configuration(config):
     r"""
@@ -340,71 +523,170 @@ def set_configuration(config):
         config_utils.TOPIC = ""
         config_utils.logger.warning("Topic to publish inference results is empty.")
 
+    if "StatsTopic" in config:
+        config_utils.STATS_TOPIC = config["StatsTopic"]
+
+    settings = {k: v for k, v in config.items() if k in runtimeconfig.FIELDS} #tuning values in the recipe, applied like those from the subscribed topic
+    if settings:
+        reconfigure(settings, "the component configuration")
+
+def reconfigure(changes, source): #applies new settings to the running stages without interrupting streaming
+    global is_single_light
+    try:
+        changed = runtime.apply(changes)
+    except ValueError as e:
+        eprint("Ignoring settings from {}: {}".format(source, e))
+        return
+    if not changed:
+        return
+    print("Settings from {}: {}".format(source, changed))
+    if "rate" in changed or "keepalive" in changed:
+        for t in targets:
+            t.scheduler.set_rate(runtime["rate"], runtime["keepalive"])
+    if "smoothing" in changed:
+        for t in targets:
+            t.output.set_time_constant(runtime["smoothing"])
+    if running_stages is None: #not streaming yet, the next run starts with the new values
+        return
+    if commandlineargs.processes and set(changed) - {"rate", "keepalive", "smoothing"}:
+        eprint("Capture and analysis run in their own processes, {} take effect after a restart".format(", ".join(changed)))
+        return
+    if "single_light" in changed:
+        is_single_light = runtime["single_light"] and all(len(t.light_locations)==1 for t in targets)
+        print("Single light source optimization", "enabled" if is_single_light else "disabled")
+        if not is_single_light and "analysis" not in running_stages.stages: #started in single light mode, analysis runs from now on
+            running_stages.add("analysis", averageimage)
+            running_stages.start("analysis")
+    if "capture_size" in changed:
+        running_stages.restart("capture") #reopens the device at the new size, the analysis stage rebuilds its regions for it
+
+def apply_settings(token): #settings stage, applies what the IPC callbacks queued
+    while not token.cancelled:
+        try:
+            source, message = settings_queue.get(timeout=.5)
+        except queue.Empty:
+            continue
+        if source == "component": #a deployment changed our configuration, read it again
+            try:
+                set_configuration(ipc_utils.IPCUtils().get_configuration(exit_on_error=False))
+            except Exception as e: #keep the settings we have, the next update reads it again
+                eprint("Reading the component configuration failed: {}".format(e))
+            continue
+        try:
+            changes = runtimeconfig.settings_from_message(message)
+        except ValueError as e:
+            eprint("Ignoring a message on {}: {}".format(source, e))
+            continue
+        unknown = [k for k in changes if k not in runtimeconfig.FIELDS]
+        if unknown:
+            verbose("Not a setting: ", unknown)
+        reconfigure(changes, source)
+
 
 ######################################################
 ############## Sending the messages ##################
 ######################################################
 
 ######### This is where we define our message format and insert our light#s, RGB values, and X,Y,Brightness ##########
-def buffer_to_light(): #Potentially thread this into 2 processes?
-    cmd = ["openssl","s_client","-dtls1_2","-cipher","PSK-AES128-GCM-SHA256","-psk_identity",clientdata['username'],"-psk",clientdata['clientkey'], "-connect", hueip+":2100"]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)            
-    lastchangetime=datetime.now()
-    lastmessage=bytes('HueStream','utf-8')
-    disabledstreaming = False
-    time.sleep(1.5) #Hold on so DTLS connection can be made & message format can get defined
-    while not stopped:
-        try:
-            bufferlock.acquire()
-            
-            message = bytes('HueStream','utf-8') + b'\1\0\0\0\0\0\0'
-            if is_single_light:
-                single_light_bytes = bytearray([int(channels[2]/2), int(channels[2]/2), int(channels[1]/2), int(channels[1]/2), int(channels[0]/2), int(channels[0]/2),] ) # channels corrected here from BGR to RGB
-                message += b'\0\0' + bytes(chr(int(1)), 'utf-8') + single_light_bytes
-            else:
-                for i in rgb_bytes:
-                    message += b'\0\0' + bytes(chr(int(i)), 'utf-8') + rgb_bytes[i]
-
-            lastmessage = message
-            lastchangetime = datetime.now()
-
-            bufferlock.release()
-            proc.stdin.write(message.decode('utf-8','ignore'))
-            time.sleep(.01) #0.01 to 0.02 (slightly under 100 or 50 messages per sec // or (.015 = ~66.6))
-            proc.stdin.flush()
-
-            #if(str(lastmessage) != str(message) or True):
-            #    if(disabledstreaming):
-            #        print('Enabling Streaming...') 
-            #        disabledstreaming = False
-            #        stopped=True #Force a rstart     
-                
-                #verbose('Wrote message and flushed. Briefly waiting') #This will verbose after every send, spamming the console.
-            #else:
-            #    if(disabledstreaming == False):
-            #        if((datetime.now()-lastchangetime).total_seconds()>15):
-            #            print('Disabling Streaming...') 
-            #            disabledstreaming = True
-            #            disablestreaming()
-            #            bufferlock.release()
-            #            time.sleep(.01)
-            #        else: 
-            #            bufferlock.release()
-            #            proc.stdin.write(message.decode('utf-8','ignore'))
-            #            time.sleep(.01) #0.01 to 0.02 (slightly under 100 or 50 messages per sec // or (.015 = ~66.6))
-            #            proc.stdin.flush()
-            #    else:
-            #        bufferlock.release()
-            #        time.sleep(.01)
+def buffer_to_light(target, token): #one streaming session to one bridge, the supervisor re-enables streaming and redoes the handshake when it fails
+    enablestreaming(target) #the bridge ends the stream after a few seconds without packets, so every session turns it back on
+    transport = dtls.DTLSTransport(target.bridge.ip, 2100, target.bridge.username, target.clientkey) #PSK-AES128-GCM-SHA256 handshake in-process, raw datagrams afterwards
+    output, scheduler = target.output, target.scheduler
+    try:
+        transport.connect(cancelled=lambda: token.cancelled)
+        verbose("DTLS handshake with the bridge {} complete".format(target.bridgeid))
+        global first_packet
+        deadline = time.monotonic() + 1.5
+        while output.updates == 0 and time.monotonic() < deadline and not token.wait(.005): #Hold on until the analysis stage filled in the first colors
+            pass
+        sender = huestream.PacketSender(target.packet, output, scheduler, transport, tracer)
+        while not token.cancelled:
+            if not sender.send_next(cancelled=lambda: token.cancelled): #waits for the next send slot while colors change or fade, or a keepalive, then writes the smoothed colors into the packet and sends it
+                break #stopping: the notify at shutdown woke it, nothing more is sent
+            if first_packet is None:
+                first_packet = time.monotonic()
+                print("First packet streamed {:.2f} s after launch, {:.2f} s after initializing".format(first_packet - launched, first_packet - initialized))
+            if transport.send_count % 1000 == 0:
+                verbose("DTLS send latency: ", transport.stats())
+                verbose("Send scheduler: ", scheduler.stats())
+    finally:
+        transport.close()
+
+def wait_for_enter(token): #ENTER on the terminal stops the program
+    while not token.cancelled:
+        if select.select([sys.stdin], [], [], .5)[0]:
+            sys.stdin.readline()
+            print("Stopping...")
+            shutdown.cancel()
 
+######################################################
+###### Process-based pipeline (--processes) ##########
+######################################################
 
-        except Exception as e:
+def watch_stop(stop_event): #forked stages get a token of their own, cancelled when the parent shuts down
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #Ctrl+C reaches the whole process group, the parent stops us in order
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) #and terminates us if that takes too long
+    token = supervisor.CancelToken()
+    def watch():
+        stop_event.wait()
+        token.cancel()
+    threading.Thread(target=watch, daemon=True).start()
+    return token
+
+def supervise_process(name, target, token): #restarts the forked stage on failure, like the supervisor does in thread mode
+    stages = supervisor.Supervisor(token, log=eprint)
+    stages.add(name, target)
+    stages.start()
+    token.wait()
+    stages.stop(timeout=2)
+
+def capture_process(frame_cond, ring_queue, stop_event):
+    global frame_slot
+    token = watch_stop(stop_event)
+    frame_slot = shmpipeline.RingPublisher(frame_cond, ring_queue) #frames are retrieved straight into a shared memory ring
+    try:
+        supervise_process("capture", cv2input_to_buffer, token)
+    finally:
+        frame_slot.close()
+
+def analysis_process(frame_cond, ring_queue, stop_event):
+    global frame_slot, w, h
+    token = watch_stop(stop_event)
+    while not token.cancelled: #the ring exists once the capture process saw its first frame
+        try:
+            descriptor = ring_queue.get(timeout=1)
+            break
+        except queue.Empty:
             pass
-
-def disablestreaming():
-    print("Disabling streaming on Entertainment area")
-    r = requests.put(url = baseurl+"/{}/groups/{}".format(clientdata['username'],groupid),json={"stream":{"active":False}}) 
-    jsondata = r.json()
+    else:
+        return
+    frame_slot = shmpipeline.SharedFrameRing.attach(frame_cond, descriptor)
+    w, h = descriptor["video_size"]
+    try:
+        supervise_process("analysis", averageimage, token)
+    finally:
+        frame_slot.close()
+
+def shared_colors_to_output(token): #runs in the main process and feeds the analysis results to every group's output stage
+    seq = 0
+    colors = np.zeros((sum(len(t.light_locations) for t in targets), 3)) #the groups' lights one after another
+    while not token.cancelled:
+        new_seq = shared_colors.wait(seq, timeout=1)
+        if new_seq == seq:
+            continue
+        seq = new_seq
+        stamp = shared_colors.read(colors)
+        start = 0
+        for t in targets:
+            stop = start + len(t.light_locations)
+            t.output.target[:] = colors[start:stop]
+            t.output.mark(stamp)
+            t.scheduler.notify()
+            start = stop
+
+def disablestreaming(target):
+    print("Disabling streaming on Entertainment area", target.name)
+    jsondata = target.bridge.put("groups/{}".format(target.groupid), {"stream":{"active":False}})
     verbose(jsondata)
 
 ######################################################
@@ -412,12 +694,18 @@ def disablestreaming():
 ######################################################
 
 def initialize():
-    stopped = False
+    global initialized, first_packet
+    initialized, first_packet = time.monotonic(), None
+    global is_single_light, shared_colors, sinks, running_stages
     setup()
     ######### Section executes video input and establishes the connection stream to bridge ##########
+    token = shutdown.child() #ends this run's stages, cancelled with the program or when the run fails
+    stages = supervisor.Supervisor(token, log=eprint) #restarts a failed stage on its own while the rest keep running
+    processes = list()
+    stats_server = stats_publisher = None
     try:
         try:
-            threads = list()
+            monitor = cpumonitor.CpuMonitor()
             verbose("Starting cv2input...")
             try:
                 subprocess.check_output("ls -ltrh /dev/video1",shell=True)
@@ -425,39 +713,129 @@ def initialize():
                 print("--- ERROR: Video capture card not detected on /dev/video1 ---")
             else:
                 print("--- INFO: Detected video capture card on /dev/video1 ---")
-                t = threading.Thread(target=cv2input_to_buffer)
-                t.start()
-                threads.append(t)
-                time.sleep(.75)
-                if (commandlineargs.single_light is True) and (len(light_locations)==1):
+                sinks = [(t.output, t.scheduler, t.light_locations, t.light_gamuts) for t in targets] #where analysis writes each group's colors
+                if runtime["single_light"] and all(len(t.light_locations)==1 for t in targets):
                     is_single_light = True
                     print("Enabled optimization for single light source") # averager thread is not utilized
                 else:
                     is_single_light = False
+                pipeline = [("capture", cv2input_to_buffer)]
+                if not is_single_light:
                     verbose("Starting image averager...")
-                    t = threading.Thread(target=averageimage)
-                    t.start()
-                    threads.append(t)
-                time.sleep(.25) #Initialize and find bridge IP before creating connection
+                    pipeline.append(("analysis", averageimage))
+
+                if commandlineargs.processes: #fork the stages before any thread of ours is running
+                    ctx = multiprocessing.get_context("fork")
+                    frame_cond, ring_queue, stop_event = ctx.Condition(), ctx.Queue(), ctx.Event()
+                    lights = {(t.bridgeid, l): loc for t in targets for l, loc in t.light_locations.items()}
+                    gamuts = {(t.bridgeid, l): g for t in targets for l, g in t.light_gamuts.items()}
+                    shared_colors = shmpipeline.SharedColors(ctx.Condition(), len(lights))
+                    sinks = [(shared_colors, shared_colors, lights, gamuts)] #the forked stages write all groups' colors into one shared block
+                    entry = {"capture": capture_process, "analysis": analysis_process}
+                    for name, target in pipeline:
+                        p = ctx.Process(target=entry[name], args=(frame_cond, ring_queue, stop_event), name=name, daemon=True)
+                        p.start()
+                        processes.append(p)
+                        monitor.add_process(name, p.pid)
+                    pipeline = [("colors", shared_colors_to_output)]
+
                 verbose("Opening SSL stream to lights...")
-                t = threading.Thread(target=buffer_to_light)
-                t.start()
-                threads.append(t)
-
-                set_configuration(ipc_utils.IPCUtils().get_configuration())        
-                ipc_utils.IPCUtils().subscribe_to_cloud(config_utils.TOPIC)
-
-                while not stopped:
-                    time.sleep(10)
-                
-                for t in threads:
-                    t.join()
+                senders = [("sender" if len(targets) == 1 else "sender-" + t.bridgeid, lambda token, t=t: buffer_to_light(t, token)) for t in targets] #one DTLS session per bridge
+                for name, target in pipeline + senders:
+                    stages.add(name, target)
+                if from_cache: #started from the cache, refetch the topology for next time now that streaming runs
+                    stages.add("bridge-cache", lambda token: refresh_topology(), restart=False)
+                if sys.stdin and sys.stdin.isatty(): #Greengrass runs us without a terminal
+                    stages.add("stdin", wait_for_enter, restart=False)
+                if greengrass:
+                    stages.add("settings", apply_settings)
+                running_stages = stages
+                stages.start()
+                for name, target in pipeline + senders:
+                    monitor.add_thread(name, stages.threads[name].native_id)
+
+                if greengrass:
+                    stats_publisher = ipc_utils.IPCUtils().telemetry_publisher(config_utils.STATS_TOPIC, interval=10) #publishes from its own thread, never blocks us
+
+                if commandlineargs.stats_port:
+                    stats_server = latency.serve_text(tracer, commandlineargs.stats_port)
+                monitor.sample()
+                tracer.roll()
+                updates, sent = sum(t.output.updates for t in targets), sum(t.scheduler.sent for t in targets)
+                while not token.wait(10):
+                    report = monitor.sample() #throughput and CPU per core and per stage, for comparing thread and process mode
+                    verbose("Pipeline ({} mode): {:.1f} color updates/s, {:.1f} packets/s, CPU %: {}".format(
+                        "process" if processes else "thread", (sum(t.output.updates for t in targets) - updates) / 10, (sum(t.scheduler.sent for t in targets) - sent) / 10, report))
+                    verbose("Stages: ", stages.stats())
+                    updates, sent = sum(t.output.updates for t in targets), sum(t.scheduler.sent for t in targets)
+                    summary = tracer.roll() #p50/p95/p99 per stage and end to end over the last 10 s
+                    summary["first_packet_s"] = None if first_packet is None else round(first_packet - initialized, 3)
+                    summary["restarts"] = stages.stats()["restarts"]
+                    summary["import_ms"] = import_ms
+                    summary["settings"] = runtime.stats()
+                    summary["snapshots"] = {t.name: t.output.snapshot.stats() for t in targets} #torn and contended reads of the colors handed to each sender
+                    if processes:
+                        summary["snapshots"]["analysis"] = shared_colors.stats()
+                    verbose("Latency: ", tracer.text())
+                    if stats_publisher is not None:
+                        stats_publisher.update(summary)
+                        verbose("Telemetry: ", stats_publisher.stats())
         except Exception as e:
             print(e)
 
-    finally: #Turn off streaming to allow normal function immedietly
-        disablestreaming()
+    finally: #Stop every stage within a few seconds, then turn off streaming to allow normal function immedietly
+        running_stages = None
+        token.cancel()
+        for t in targets:
+            t.scheduler.notify() #wakes the sender if it waits for a keepalive
+        leaked = stages.stop(timeout=SHUTDOWN_TIMEOUT)
+        if leaked:
+            eprint("Stages still running after {} s: {}".format(SHUTDOWN_TIMEOUT, ", ".join(leaked)))
+        token.detach()
+        if processes:
+            stop_event.set()
+            for p in processes:
+                p.join(SHUTDOWN_TIMEOUT / 2)
+                if p.is_alive():
+                    p.terminate()
+                    p.join(1)
+            shared_colors.close()
+        if stats_server is not None:
+            stats_server.shutdown()
+            stats_server.server_close()
+        if stats_publisher is not None:
+            stats_publisher.close(timeout=SHUTDOWN_TIMEOUT / 2) #sends the last summary unless IPC hangs
+        tracer.close()
+        for t in targets:
+            try:
+                disablestreaming(t)
+            except requests.RequestException as e:
+                eprint("Disabling streaming on {} failed: {}".format(t.name, e))
+
+def request_shutdown(signum, frame):
+    shutdown.cancel()
 
-while True:
-    print("Initializing...")
-    initialize()
+if __name__ == "__main__":
+    verbose("Imports: {} ({:.0f} ms in total)".format(", ".join("{} {:g} ms".format(k, v) for k, v in import_ms.items()), sum(import_ms.values())))
+    if greengrass:
+        try:
+            ipc_utils.get_client() #the nucleus refusing us is not worth retrying
+        except Exception as e:
+            eprint("Connecting to the Greengrass nucleus failed ({}), use --standalone to run without it".format(e))
+            sys.exit(1)
+        ipc = ipc_utils.IPCUtils() #one instance over the shared IPC connection
+        set_configuration(ipc.get_configuration())
+        if config_utils.TOPIC: #settings arrive for as long as we run, each run's settings stage applies them
+            ipc.subscribe_to_cloud(config_utils.TOPIC, on_message=lambda topic, message: settings_queue.put((topic, message)))
+        ipc.subscribe_to_configuration_updates(lambda key_path: settings_queue.put(("component", key_path)))
+    else:
+        print("Running standalone, without Greengrass")
+    signal.signal(signal.SIGINT, request_shutdown) #Ctrl+C and SIGTERM (Greengrass stopping the component) shut down cleanly
+    signal.signal(signal.SIGTERM, request_shutdown)
+    while not shutdown.cancelled:
+        print("Initializing...")
+        try:
+            initialize()
+        except (requests.RequestException, dtls.DTLSError) as e: #bridge discovery or setup failed, e.g. the bridge being unreachable
+            eprint("Initializing failed: {}".format(e))
+        shutdown.wait(5) #a failed run is retried shortly
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Client for the Hue bridge's v1 REST API used to set up streaming.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = 5
+
+
+def error_of(response):
+    """Returns the description of the first error in a bridge response, or None."""
+    if isinstance(response, list):
+        for item in response:
+            if isinstance(item, dict) and "error" in item:
+                return item["error"].get("description", str(item["error"]))
+    return None
+
+
+class BridgeClient:
+    """Talks to one bridge over a pooled keep-alive session.
+
+    Paths are relative to /api/<username>/ (or /api/ with auth=False). Every call
+    has a timeout, GET responses are kept for the rest of the session so each
+    resource is fetched only once (pass refresh=True to fetch it again), and
+    `fetch` requests independent resources concurrently.
+    """
+
+    def __init__(self, ip, username=None, timeout=DEFAULT_TIMEOUT, workers=4):
+        self.ip = ip
+        self.username = username
+        self.timeout = timeout
+        self.baseurl = "http://{}/api".format(ip)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.workers = workers
+        self.responses = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def url(self, path, auth=True):
+        parts = [self.baseurl] + ([self.username] if auth else []) + ([path] if path else [])
+        return "/".join(parts)
+
+    def request(self, method, path, body=None, auth=True, timeout=None):
+        with self.lock:
+            self.requests += 1
+        r = self.session.request(method, self.url(path, auth), json=body,
+                                 timeout=self.timeout if timeout is None else timeout)
+        return r.json()
+
+    def get(self, path, auth=True, timeout=None, refresh=False):
+        key = self.url(path, auth)
+        if not refresh:
+            with self.lock:
+                if key in self.responses:
+                    return self.responses[key]
+        response = self.request("GET", path, auth=auth, timeout=timeout)
+        with self.lock:
+            self.responses[key] = response
+        return response
+
+    def put(self, path, body, auth=True, timeout=None):
+        return self.request("PUT", path, body, auth, timeout)
+
+    def post(self, path, body, auth=True, timeout=None):
+        return self.request("POST", path, body, auth, timeout)
+
+    def fetch(self, *paths, refresh=False, timeout=None):
+        """GETs all `paths` at once and returns their responses in the same order."""
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(paths)) or 1) as pool:
+            futures = [pool.submit(self.get, p, timeout=timeout, refresh=refresh) for p in paths]
+            return [f.result() for f in futures]
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+HueStream v1 packet encoding for the Hue Entertainment API.
+https://developers.meethue.com/develop/hue-entertainment/philips-hue-entertainment-api/
+"""
+import threading
+import time
+
+import numpy as np
+
+import framesync
+import latency
+
+# "HueStream", version 1.0, sequence id, 2 reserved, color space (0 = RGB), 1 reserved
+HEADER = b'HueStream' + bytes([0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+LIGHT_SIZE = 9  # device type, 16-bit light id, 16-bit red, green and blue
+LIGHT_TYPE = 0x00
+
+
+class HueStreamPacket:
+    """One preallocated HueStream message for a fixed set of lights.
+
+    The header and light ids are written once. `colors` is an (N, 3) big-endian
+    uint16 NumPy view onto the color fields of the buffer, in the order the
+    lights were given, so the analysis stage can write 16-bit values in place
+    and the sender can pass `buffer` straight to the transport.
+    """
+
+    def __init__(self, light_ids):
+        self.light_ids = [int(i) for i in light_ids]
+        self.buffer = bytearray(len(HEADER) + LIGHT_SIZE * len(self.light_ids))
+        self.buffer[:len(HEADER)] = HEADER
+        for n, light_id in enumerate(self.light_ids):
+            offset = len(HEADER) + LIGHT_SIZE * n
+            self.buffer[offset] = LIGHT_TYPE
+            self.buffer[offset + 1:offset + 3] = light_id.to_bytes(2, 'big')
+        self.colors = np.ndarray(
+            shape=(len(self.light_ids), 3),
+            dtype='>u2',
+            buffer=self.buffer,
+            offset=len(HEADER) + 3,
+            strides=(LIGHT_SIZE, 2),
+        )
+
+    def set_rgb8(self, rgb):
+        """Writes an (N, 3) array of 0-255 values, scaled to the full 16-bit range."""
+        np.multiply(rgb, np.uint16(257), out=self.colors, casting='unsafe')
+
+    def __len__(self):
+        return len(self.buffer)
+
+
+class ColorSmoother:
+    """Temporal output stage between the analysis results and the packet.
+
+    The analysis stage writes 16-bit target colors (`target`, `set_rgb8`) whenever
+    it finishes a frame; the sender calls `step` at its own rate, which moves the
+    current colors towards the targets with an exponential filter of
+    `time_constant` seconds and writes them into the packet. The blend factor
+    1 - exp(-dt / time_constant) depends only on elapsed time, so fades look the
+    same whatever the capture or send rate. `time_constant` may be a scalar or
+    one value per light; 0 passes targets straight through.
+    Differences of at most `threshold` (16-bit units) are snapped, which is what
+    lets `pending` become False once a fade has finished.
+
+    `target` belongs to the analysis stage; `mark` publishes it with its grab
+    time as one framesync.ColorSnapshot, and the sender only ever works on the
+    newest whole snapshot (`latest`, `target_time`), so a packet never mixes
+    two analysis results and neither side waits for the other.
+    """
+
+    def __init__(self, packet, time_constant=0.0, threshold=256):
+        self.packet = packet
+        self.target = np.zeros(packet.colors.shape)
+        self.current = np.zeros(packet.colors.shape)
+        self.snapshot = framesync.ColorSnapshot(len(self.target))
+        self.latest = np.zeros(packet.colors.shape)
+        self.latest_seq = 0
+        self.threshold = threshold
+        self.set_time_constant(time_constant)
+        self.target_time = None
+        self.last_step = None
+        self.updates = 0
+
+    def set_time_constant(self, time_constant):
+        self.time_constant = np.broadcast_to(
+            np.asarray(time_constant, dtype=np.float64).reshape(-1, 1), (len(self.target), 1)
+        ).copy()
+
+    def set_rgb8(self, rgb, rows=slice(None)):
+        """Sets the targets of `rows` from 0-255 values."""
+        self.target[rows] = np.asarray(rgb, dtype=np.float64) * 257
+
+    def mark(self, stamp=None):
+        """Publishes the targets the analysis stage wrote, from the frame grabbed
+        at `stamp` (time.monotonic_ns(), default now)."""
+        self.snapshot.publish(self.target, time.monotonic_ns() if stamp is None else stamp)
+        self.updates += 1
+
+    def _refresh(self):
+        if self.snapshot.seq != self.latest_seq:
+            self.latest_seq, self.target_time = self.snapshot.read(self.latest)
+
+    def pending(self):
+        """True while the packet still differs from the targets by more than `threshold`."""
+        self._refresh()
+        return np.abs(self.latest - self.current).max(initial=0) > self.threshold
+
+    def step(self, now=None):
+        """Advances the filter to `now` and writes the result into the packet."""
+        now = time.monotonic() if now is None else now
+        dt = 0.0 if self.last_step is None else now - self.last_step
+        self.last_step = now
+        with np.errstate(divide='ignore', invalid='ignore'):
+            alpha = -np.expm1(-dt / self.time_constant)
+        alpha[self.time_constant <= 0] = 1.0
+        self._refresh()
+        target = self.latest
+        self.current += alpha * (target - self.current)
+        settled = np.abs(target - self.current) <= self.threshold
+        self.current[settled] = target[settled]
+        np.rint(self.current, out=self.current)
+        self.packet.colors[:] = self.current
+
+
+class SendScheduler:
+    """Decides when the streaming loop sends the packet.
+
+    Sends happen on a fixed-phase grid of 1/`rate` seconds (deadlines are absolute,
+    so pacing does not drift with loop overhead) but only while the output stage
+    has something new: the analysis stage calls `notify` after updating the
+    targets, and the packet is sent at every free slot while `output.pending()`.
+    Otherwise sends drop to `keepalive` per second, which keeps the bridge's 10
+    second streaming timeout from expiring. Lateness of each rate-limited send
+    against its slot is tracked as jitter.
+    """
+
+    def __init__(self, output, rate=50, keepalive=2):
+        self.output = output
+        self.interval = 1.0 / rate
+        self.keepalive_interval = 1.0 / keepalive
+        self.changed = threading.Event()
+        self.next_allowed = 0.0
+        self.last_send = 0.0
+        self.sent = 0
+        self.keepalives = 0
+        self.deduplicated = 0
+        self.jitter_samples = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+
+    def set_rate(self, rate, keepalive):
+        """Changes the send and keepalive rates, from the next send on."""
+        self.interval = 1.0 / rate
+        self.keepalive_interval = 1.0 / keepalive
+        self.changed.set()  # a sender waiting for the old keepalive deadline looks again
+
+    def notify(self):
+        """Called by the analysis stage after it updated the output targets."""
+        self.changed.set()
+
+    def _sleep_until(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return  # slot already free, nothing to be late for
+        time.sleep(remaining)
+        lateness = time.monotonic() - deadline
+        self.jitter_samples += 1
+        self.jitter_total += lateness
+        if lateness > self.jitter_max:
+            self.jitter_max = lateness
+
+    def wait(self, cancelled=None):
+        """Blocks until the packet should be sent, which is at most one keepalive
+        interval after the previous send. Returns True then, or False as soon as
+        `cancelled()` is true after a `notify`, in which case nothing should be sent."""
+        keepalive_deadline = self.last_send + self.keepalive_interval
+        while not self.output.pending():
+            if cancelled is not None and cancelled():
+                return False
+            remaining = keepalive_deadline - time.monotonic()
+            if remaining <= 0:
+                self.keepalives += 1
+                break
+            if self.changed.wait(remaining):
+                self.changed.clear()
+                if not self.output.pending():
+                    self.deduplicated += 1
+        self._sleep_until(self.next_allowed)
+        return cancelled is None or not cancelled()
+
+    def sent_now(self):
+        """Records that the packet was just sent."""
+        now = time.monotonic()
+        if now - self.next_allowed < self.interval:
+            self.next_allowed += self.interval  # keep the send grid's phase while busy
+        else:
+            self.next_allowed = now + self.interval
+        self.last_send = now
+        self.sent += 1
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "keepalives": self.keepalives,
+            "deduplicated": self.deduplicated,
+            "jitter_avg_ms": 1000 * self.jitter_total / self.jitter_samples if self.jitter_samples else 0.0,
+            "jitter_max_ms": 1000 * self.jitter_max,
+        }
+
+
+class PacketSender:
+    """One pass of the streaming loop: waits for the scheduler's next slot, steps
+    the output stage into the packet and sends it through `transport` (anything
+    with `send(buffer)`, e.g. dtls.DTLSTransport). Encode and send times, and the
+    end to end latency of the first packet carrying each new analysis result,
+    are recorded in `tracer`.
+    """
+
+    def __init__(self, packet, output, scheduler, transport, tracer):
+        self.packet = packet
+        self.output = output
+        self.scheduler = scheduler
+        self.transport = transport
+        self.tracer = tracer
+        self.traced_update = 0
+
+    def send_next(self, cancelled=None):
+        """Sends the next packet, or nothing if `cancelled()` became true while
+        waiting for its slot. Returns whether it sent."""
+        if not self.scheduler.wait(cancelled):
+            return False
+        started = time.monotonic_ns()
+        self.output.step()
+        encoded = time.monotonic_ns()
+        self.transport.send(self.packet.buffer)
+        sent = time.monotonic_ns()
+        self.scheduler.sent_now()
+        self.tracer.record(latency.ENCODE, started, encoded)
+        self.tracer.record(latency.SEND, encoded, sent)
+        self.tracer.count(latency.SENT)
+        if self.output.latest_seq != self.traced_update and self.output.target_time is not None:
+            self.traced_update = self.output.latest_seq
+            self.tracer.record(latency.END_TO_END, self.output.target_time, sent)
+        return True
+
+
+class StreamTarget:
+    """One bridge's entertainment group and what streams to it: the bridge client
+    (hueapi.BridgeClient), the client key of its DTLS session and the packet,
+    smoother and scheduler of its lights. A bridge streams one group at a time,
+    so there is one target, and one DTLS session, per bridge.
+    """
+
+    def __init__(self, bridge, bridgeid, groupid, clientkey, light_locations, light_gamuts,
+                 time_constant=0.0, rate=50, keepalive=2):
+        self.bridge = bridge
+        self.bridgeid = bridgeid
+        self.groupid = groupid
+        self.clientkey = clientkey
+        self.light_locations = light_locations
+        self.light_gamuts = light_gamuts
+        self.packet = HueStreamPacket(light_locations)
+        self.output = ColorSmoother(self.packet, time_constant=time_constant)
+        self.scheduler = SendScheduler(self.output, rate=rate, keepalive=keepalive)
+
+    @property
+    def name(self):
+        return "{}/{}".format(self.bridgeid, self.groupid)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage latency tracing for the capture -> analysis -> send pipeline.
+"""
+import multiprocessing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+
+import numpy as np
+
+STAGES = ("grab", "retrieve", "average", "convert", "encode", "send", "end_to_end")
+GRAB, RETRIEVE, AVERAGE, CONVERT, ENCODE, SEND, END_TO_END = range(len(STAGES))
+
+COUNTERS = ("captured", "analysed", "dropped", "sent", "skipped", "reused")
+CAPTURED, ANALYSED, DROPPED, SENT, SKIPPED, REUSED = range(len(COUNTERS))  # skipped frames, reused light results
+
+# Log-linear buckets: 4 per power of two of the duration in nanoseconds (<= 19% wide).
+BUCKETS = 64 * 4
+
+
+def bucket_bounds(idx):
+    """Returns the [low, high) nanosecond range of a histogram bucket."""
+    octave, sub = idx >> 2, idx & 3
+    if octave <= 3:
+        return (1 << octave) >> 1, 1 << octave
+    return (4 + sub) << (octave - 3), (5 + sub) << (octave - 3)
+
+
+class LatencyRecorder:
+    """Latency histograms and counters for the pipeline stages.
+
+    `record` costs a subtraction, an int.bit_length and one array increment under
+    a lock: every bridge's sender thread records the encode, send and end to end
+    stages, and an unlocked `+=` from two of them at once loses counts. Times
+    are time.monotonic_ns() values, which are comparable across processes; with
+    shared=True the histograms live in shared memory and the lock is a
+    process-shared one, so forked stages (--processes) record into the same
+    tables. `roll` computes p50/p95/p99, fps and drop counts over the interval
+    since the previous roll.
+    """
+
+    def __init__(self, shared=False):
+        size = 8 * (len(STAGES) * BUCKETS + len(COUNTERS))
+        if shared:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.lock = multiprocessing.get_context("fork").Lock()  # created before the stages fork
+            buf = self.shm.buf
+        else:
+            self.shm = None
+            self.lock = threading.Lock()
+            buf = bytearray(size)
+        self.histograms = np.ndarray((len(STAGES), BUCKETS), dtype=np.int64, buffer=buf)
+        self.counters = np.ndarray((len(COUNTERS),), dtype=np.int64, buffer=buf, offset=8 * len(STAGES) * BUCKETS)
+        self.histograms[:] = 0
+        self.counters[:] = 0
+        self._last = (time.monotonic(), self.histograms.copy(), self.counters.copy())
+        self.last_summary = {}
+
+    def record(self, stage, start, end=None):
+        """Adds the duration from `start` to `end` (default: now), both monotonic_ns, to `stage`."""
+        d = (time.monotonic_ns() if end is None else end) - start
+        b = d.bit_length()
+        idx = (b << 2) | ((d >> (b - 3)) & 3) if b > 3 else b << 2
+        with self.lock:
+            self.histograms[stage, idx] += 1
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    @staticmethod
+    def percentiles(histogram, quantiles=(0.5, 0.95, 0.99)):
+        """Upper bucket bounds, in milliseconds, below which the given fractions of samples fall."""
+        total = histogram.sum()
+        if not total:
+            return [None] * len(quantiles)
+        cumulative = np.cumsum(histogram)
+        idx = np.searchsorted(cumulative, np.array(quantiles) * total)
+        return [round(bucket_bounds(int(i))[1] / 1e6, 3) for i in idx]
+
+    def roll(self):
+        """Summarises the interval since the previous call into `last_summary` and returns it."""
+        now, histograms, counters = time.monotonic(), self.histograms.copy(), self.counters.copy()
+        then, last_histograms, last_counters = self._last
+        self._last = (now, histograms, counters)
+        elapsed = max(now - then, 1e-9)
+        window = histograms - last_histograms
+        counts = counters - last_counters
+        summary = {"interval_s": round(elapsed, 3)}
+        for name, counter in zip(COUNTERS, counts):
+            summary[name] = int(counter)
+        summary["fps"] = round(counts[CAPTURED] / elapsed, 2)
+        summary["analysis_fps"] = round(counts[ANALYSED] / elapsed, 2)
+        summary["packets_per_s"] = round(counts[SENT] / elapsed, 2)
+        summary["skip_ratio"] = round(counts[SKIPPED] / max(counts[SKIPPED] + counts[ANALYSED], 1), 3)
+        for name, histogram in zip(STAGES, window):
+            p50, p95, p99 = self.percentiles(histogram)
+            summary[name] = {"count": int(histogram.sum()), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+        self.last_summary = summary
+        return summary
+
+    def text(self):
+        """`last_summary` as plain text, one line per stage."""
+        s = self.last_summary
+        if not s:
+            return "no data yet\n"
+        lines = ["interval_s {interval_s} fps {fps} analysis_fps {analysis_fps} packets_per_s {packets_per_s} "
+                 "captured {captured} analysed {analysed} dropped {dropped} sent {sent} "
+                 "skipped {skipped} reused {reused} skip_ratio {skip_ratio}".format(**s)]
+        for name in STAGES:
+            lines.append("{} count {count} p50_ms {p50_ms} p95_ms {p95_ms} p99_ms {p99_ms}".format(name, **s[name]))
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self.shm is not None:
+            self.histograms = self.counters = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def serve_text(recorder, port, host="127.0.0.1"):
+    """Serves `recorder.text()` over HTTP on host:port from a daemon thread. Returns the server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = recorder.text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="latency-endpoint", daemon=True).start()
+    return server
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Region averaging for Harmonize Project.
+Computes the mean color of every light's screen region from one shared pass
+over each frame instead of one cv2.mean call per region.
+"""
+import math
+import time
+
+import cv2
+import numpy as np
+
+REGION_MODELS = ("box", "gaussian", "edge")
+SAMPLE_WIDTH = 160  # columns of the downsampled frame weighted regions are applied to
+EDGE_DEPTH = .1  # share of the picture's width or height an edge strip reaches in from the border
+MAX_STRIDE = 16  # most rows a time budget may skip between two sampled ones
+
+
+class RegionAverager:
+    """Averages many (possibly overlapping) rectangles of a frame using a summed-area table.
+
+    Bounds are given once as [top, bottom, left, right] per light and are clipped
+    to the frame the first time a new frame shape is seen. Each call to `means`
+    then costs one cv2.integral over the bounding box of all regions plus four
+    lookups per light, so the cost no longer grows with the number of lights
+    times the region area, and pixels no light looks at (e.g. outside --crop) are
+    never read. The table is allocated once per frame shape and reused.
+    `channels` optionally reorders the result columns, e.g. [2, 1, 0] to average
+    a BGR frame as captured and return RGB means.
+
+    With a `stride` above 1 the means are approximate: only every stride-th row
+    is read, through a strided view of the frame, so the cost falls with
+    1/stride. Rows stay whole because OpenCV reads a row-strided view in place,
+    while skipping columns too makes it copy the view first, which was measured
+    slower than the exact mean. With a `budget` (seconds per frame) the stride
+    adapts between `stride` and `max_stride` so `means` fits in it.
+    """
+
+    def __init__(self, bounds, channels=None, stride=1, budget=None, max_stride=MAX_STRIDE):
+        self.bounds = np.array(bounds, dtype=np.intp).reshape(-1, 4)
+        self.channels = channels
+        self.stride = self.min_stride = max(int(stride), 1)
+        self.max_stride = max(max_stride, self.stride)
+        self.budget = budget
+        self.cost = None  # seconds a full-resolution pass would take, estimated from the timed ones
+        self.shape = None
+        self.table = None
+
+    def _prepare(self, shape, dtype):
+        h, w = shape[:2]
+        top, bottom, left, right = np.clip(self.bounds.T, 0, [[h], [h], [w], [w]])
+        bottom = np.maximum(bottom, top)
+        right = np.maximum(right, left)
+        self.clipped = (top, bottom, left, right)
+        # Only the bounding box of all regions is integrated, lookups are relative to it.
+        y0, y1 = (int(top.min()), int(bottom.max())) if len(top) else (0, h)
+        x0, x1 = (int(left.min()), int(right.max())) if len(left) else (0, w)
+        s = self.stride
+        self.window = (slice(y0, y1, s), slice(x0, x1))
+        # Rows of the strided window that fall inside each region, a region thinner than the stride keeps the row above it.
+        first, end = -(-(top - y0) // s), -(-(bottom - y0) // s)
+        thin = (end <= first) & (bottom > top)
+        first[thin] = (top[thin] - y0) // s
+        end[thin] = first[thin] + 1
+        self.top, self.bottom, self.left, self.right = first, end, left - x0, right - x0
+        # Empty regions (lights off screen) average to 0 like cv2.mean does.
+        self.area = np.maximum((end - first) * (right - left), 1)[:, None]
+        self.sdepth = cv2.CV_32S if dtype == np.uint8 else cv2.CV_64F
+        channels = shape[2] if len(shape) > 2 else 1
+        self.window_area = -(-(y1 - y0) // s) * (x1 - x0)
+        self.table = np.empty((-(-(y1 - y0) // s) + 1, x1 - x0 + 1, channels),
+                              dtype=np.int32 if self.sdepth == cv2.CV_32S else np.float64)
+        self.shape = shape
+
+    def _adapt(self, elapsed):
+        """Picks the stride for the next frame from the time `means` took on this one."""
+        full = elapsed * self.stride
+        self.cost = full if self.cost is None else .8 * self.cost + .2 * full
+        stride = self.stride
+        if self.cost / stride > self.budget:
+            stride = math.ceil(self.cost / self.budget)
+        elif stride > self.min_stride and self.cost / (stride - 1) < .8 * self.budget:  # a margin, so it does not flip every frame
+            stride -= 1
+        stride = min(max(stride, self.min_stride), self.max_stride)
+        if stride != self.stride:
+            self.stride = stride
+            self.shape = None  # the table is laid out again on the next frame
+
+    def sums(self, frame):
+        """Returns the (N, C) per-region channel sums of an (H, W, C) frame."""
+        if frame.shape != self.shape:
+            self._prepare(frame.shape, frame.dtype)
+        table = self.table
+        cv2.integral(frame[self.window], table, sdepth=self.sdepth)
+        return (table[self.bottom, self.right].astype(np.int64)
+                - table[self.top, self.right]
+                - table[self.bottom, self.left]
+                + table[self.top, self.left])
+
+    def means(self, frame):
+        """Returns the (N, C) per-region channel means of an (H, W, C) frame."""
+        started = time.perf_counter() if self.budget else 0
+        means = self.sums(frame) / self.area
+        if self.channels is not None:
+            means = means[:, self.channels]
+        if self.budget:
+            self._adapt(time.perf_counter() - started)
+        return means
+
+    def means_of(self, frame, rows):
+        """Returns the (len(rows), C) means of only the regions `rows`. When they cover
+        less than half of the integrated window each is averaged on its own, which
+        reads only its pixels; otherwise this is `means(frame)[rows]`."""
+        if frame.shape != self.shape:
+            self._prepare(frame.shape, frame.dtype)
+        if self.area[rows].sum() * 2 >= self.window_area:
+            return self.means(frame)[rows]
+        channels = self.shape[2] if len(self.shape) > 2 else 1
+        s, y0 = self.stride, self.window[0].start
+        top, bottom = y0 + self.top * s, y0 + self.bottom * s  # the rows the table would have read
+        _, _, left, right = self.clipped
+        means = np.array([cv2.mean(frame[top[i]:bottom[i]:s, left[i]:right[i]])[:channels] for i in rows])
+        if self.channels is not None:
+            means = means[:, self.channels]
+        return means
+
+
+def _sparse():
+    """scipy.sparse, or None without SciPy (the weights are then kept as a dense matrix).
+    Imported on first use, only the weighted region models need it."""
+    try:
+        import scipy.sparse
+    except ImportError:
+        return None
+    return scipy.sparse
+
+
+def _axis_weights(model, centres, low, high, span, cell):
+    """Weights along one axis of the grid (cell centres at `centres`) for a region
+    from `low` to `high` inside the picture's [span[0], span[1]) range."""
+    inside = (centres >= span[0]) & (centres < span[1])
+    if model == "gaussian":  # a quarter of the region's size is one standard deviation, cut off at three
+        sigma = max((high - low) / 4, cell / 2)
+        d = (centres - (low + high) / 2) / sigma
+        w = np.where(np.abs(d) <= 3, np.exp(-.5 * d * d), 0)
+    else:
+        w = ((centres >= low) & (centres < high)).astype(np.float64)
+    w *= inside
+    if not w.any():  # smaller than a grid cell, the cell under its centre stands in for it
+        w[min(max(int((low + high) / 2 / cell), 0), len(centres) - 1)] = 1
+    return w
+
+
+def region_weights(model, bounds, grid, scale, picture):
+    """Builds the row-normalised (N, rows * columns) weights of `model` for regions
+    given as [top, bottom, left, right] frame pixels, over a grid of `grid` (rows,
+    columns) cells of `scale` (height, width) frame pixels each. `picture` (x, y,
+    width, height) is the part of the frame the lights map to; "edge" regions are
+    the strip of it along the border nearest to each region. Every model is
+    separable, so each mask is the outer product of a row and a column profile.
+    Returns a scipy CSR matrix, or a dense array without scipy."""
+    gh, gw = grid
+    sy, sx = scale
+    ys = (np.arange(gh) + .5) * sy  # frame coordinates of the cell centres
+    xs = (np.arange(gw) + .5) * sx
+    px, py, pw, ph = picture
+    rows, cols, vals = [], [], []
+    for i, (top, bottom, left, right) in enumerate(bounds):
+        if model == "edge":
+            cx, cy = (left + right) / 2, (top + bottom) / 2
+            side = np.argmin([(cx - px) / pw, (px + pw - cx) / pw, (cy - py) / ph, (py + ph - cy) / ph])
+            dx, dy = pw * EDGE_DEPTH, ph * EDGE_DEPTH
+            top, bottom, left, right = [
+                (top, bottom, px, px + dx), (top, bottom, px + pw - dx, px + pw),
+                (py, py + dy, left, right), (py + ph - dy, py + ph, left, right)][side]
+        wy = _axis_weights(model, ys, top, bottom, (py, py + ph), sy)
+        wx = _axis_weights(model, xs, left, right, (px, px + pw), sx)
+        mask = np.outer(wy, wx).ravel()
+        nz = np.flatnonzero(mask)
+        rows.append(np.full(len(nz), i))
+        cols.append(nz)
+        vals.append(mask[nz] / mask[nz].sum())
+    rows, cols, vals = (np.concatenate(a) if a else np.empty(0) for a in (rows, cols, vals))
+    shape = (len(bounds), gh * gw)
+    sparse = _sparse()
+    if sparse is not None:
+        return sparse.csr_matrix((vals.astype(np.float32), (rows, cols)), shape=shape)
+    weights = np.zeros(shape, dtype=np.float32)
+    weights[rows, cols] = vals
+    return weights
+
+
+class WeightedAverager:
+    """Averages every light's weighted region of a frame with one matrix product.
+
+    The frame is shrunk to `sample_width` columns with cv2.resize (INTER_AREA, so
+    every pixel still counts) and multiplied by the lights x pixels weight matrix
+    of all regions (see region_weights), sparse when scipy is installed. The
+    weights and the downsampled frame are built once per frame shape; a new light
+    layout gets a new averager. Same interface as RegionAverager.
+    """
+
+    def __init__(self, bounds, model="gaussian", picture=None, sample_width=SAMPLE_WIDTH, channels=None):
+        self.bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        self.model = model
+        self.picture = picture
+        self.sample_width = sample_width
+        self.channels = channels
+        self.shape = None
+        self.weights = None
+
+    def _prepare(self, shape):
+        h, w = shape[:2]
+        gw = min(self.sample_width, w)
+        gh = max(int(round(h * gw / w)), 1)
+        self.size = (gw, gh)
+        self.weights = region_weights(self.model, self.bounds, (gh, gw), (h / gh, w / gw), self.picture or (0, 0, w, h))
+        self.small = np.empty((gh, gw) + tuple(s for s in shape[2:] if s > 1), dtype=np.uint8)
+        self.shape = shape
+
+    def means(self, frame):
+        """Returns the (N, C) per-region weighted channel means of an (H, W, C) frame."""
+        if frame.shape != self.shape:
+            self._prepare(frame.shape)
+        small = cv2.resize(frame, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+        means = np.asarray(self.weights @ small.reshape(self.size[0] * self.size[1], -1).astype(np.float32))
+        if self.channels is not None:
+            means = means[:, self.channels]
+        return means
+
+
+def averager(bounds, model=None, picture=None, channels=None, stride=1, budget=None):
+    """RegionAverager for plain "box" regions, sampling every `stride`-th row within a `budget`
+    if given, WeightedAverager for the other models (which always average a downsampled frame)."""
+    if model in (None, "box"):
+        return RegionAverager(bounds, channels=channels, stride=stride, budget=budget)
+    return WeightedAverager(bounds, model, picture, channels=channels)
+
+
+def table_bytes(width, height, raw=None):
+    """Upper bound of the summed-area table memory for one width x height frame (BGR, or raw YUYV/NV12)."""
+    if raw == "yuyv":
+        return (height + 1) * (width // 2 + 1) * 4 * 4
+    if raw == "nv12":
+        return (height + 1) * (width + 1) * 4 + (height // 2 + 1) * (width // 2 + 1) * 2 * 4
+    return (height + 1) * (width + 1) * 3 * 4
+
+
+FRAME_BYTES_PER_PIXEL = {None: 3, "yuyv": 2, "nv12": 1.5}
+
+
+# ITU-R BT.601 limited range, the same coefficients OpenCV uses to decode YUYV/NV12.
+YUV_OFFSET = np.array([16.0, 128.0, 128.0])
+YUV_TO_RGB = np.array([
+    [1.164, 0.0, 1.596],
+    [1.164, -0.392, -0.813],
+    [1.164, 2.017, 0.0],
+])
+
+
+def yuv_to_rgb(yuv):
+    """Converts an (N, 3) array of Y, U, V means to (N, 3) 0-255 RGB."""
+    return np.clip((np.asarray(yuv) - YUV_OFFSET) @ YUV_TO_RGB.T, 0, 255)
+
+
+class YUYVRegionAverager:
+    """RegionAverager for raw packed YUYV (YUY2) capture buffers.
+
+    The buffer is viewed as (H, W/2, 4) macropixels of Y0 U Y1 V, so one summed-area
+    table gives luma and both chroma means per region; only the N means are
+    converted to RGB. Region edges are rounded to whole macropixels.
+    """
+
+    def __init__(self, bounds, width, height, model=None, picture=None, stride=1, budget=None):
+        self.width = width
+        self.height = height
+        bounds = np.array(bounds, dtype=np.intp).reshape(-1, 4)
+        if picture is not None:
+            picture = (picture[0] // 2, picture[1], picture[2] // 2, picture[3])
+        self.macropixels = averager(bounds // [1, 1, 2, 2], model, picture, stride=stride, budget=budget)
+
+    @property
+    def stride(self):
+        return getattr(self.macropixels, "stride", 1)
+
+    def means(self, frame):
+        """Returns the (N, 3) RGB means of a raw YUYV buffer of any shape."""
+        m = self.macropixels.means(frame.reshape(self.height, self.width // 2, 4))
+        return yuv_to_rgb(np.stack(((m[:, 0] + m[:, 2]) / 2, m[:, 1], m[:, 3]), axis=1))
+
+
+class NV12RegionAverager:
+    """RegionAverager for raw NV12 capture buffers (full-size Y plane followed
+    by a half-size interleaved UV plane). Only the N means are converted to RGB."""
+
+    def __init__(self, bounds, width, height, model=None, picture=None, stride=1, budget=None):
+        self.width = width
+        self.height = height
+        bounds = np.array(bounds, dtype=np.intp).reshape(-1, 4)
+        self.luma = averager(bounds, model, picture, stride=stride, budget=budget and budget * 2 / 3)  # the luma plane is two thirds of the buffer
+        self.chroma = averager(bounds // 2, model, picture and tuple(v // 2 for v in picture), stride=stride, budget=budget and budget / 3)
+
+    @property
+    def stride(self):
+        return getattr(self.luma, "stride", 1)
+
+    def means(self, frame):
+        """Returns the (N, 3) RGB means of a raw NV12 buffer of any shape."""
+        frame = frame.reshape(-1)
+        split = self.width * self.height
+        y = self.luma.means(frame[:split].reshape(self.height, self.width, 1))
+        uv = self.chroma.means(frame[split:].reshape(self.height // 2, self.width // 2, 2))
+        return yuv_to_rgb(np.concatenate((y, uv), axis=1))
+
+
+RAW_FORMATS = {
+    "yuyv": ("YUYV", YUYVRegionAverager),
+    "nv12": ("NV12", NV12RegionAverager),
+}
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Settings of Harmonize Project that can change while it streams, fed by the
+subscribed IoT Core topic and Greengrass component configuration updates.
+"""
+import json
+import re
+import threading
+
+import regions
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ("true", "1", "yes", "on"):
+        return True
+    if str(value).lower() in ("false", "0", "no", "off"):
+        return False
+    raise ValueError("not a boolean")
+
+
+def _size(value):  # "WIDTHxHEIGHT", "" for the device's default
+    value = str(value or "").lower()
+    if value and not re.fullmatch(r"\d+x\d+", value):
+        raise ValueError("not WIDTHxHEIGHT")
+    return value
+
+
+def _crop(value):  # "X,Y,WIDTH,HEIGHT", "" for the whole frame
+    value = str(value or "").replace(" ", "")
+    if value and not re.fullmatch(r"\d+,\d+,\d+,\d+", value):
+        raise ValueError("not X,Y,WIDTH,HEIGHT")
+    if value and 0 in [int(v) for v in value.split(",")[2:]]:
+        raise ValueError("empty crop")
+    return value
+
+
+def _check_crop(crop, size):
+    """Raises ValueError if the crop "X,Y,WIDTH,HEIGHT" does not fit in a (width, height) frame."""
+    if not crop or not size:
+        return
+    x, y, cw, ch = [int(v) for v in crop.split(",")]
+    if x + cw > size[0] or y + ch > size[1]:
+        raise ValueError("crop={!r} (outside the {}x{} capture)".format(crop, size[0], size[1]))
+
+
+# name: (type, check), every setting the running stages pick up without a restart
+FIELDS = {
+    "breadth": (float, lambda v: 0 < v <= 1),
+    "regions": (str, lambda v: v in regions.REGION_MODELS),
+    "change_threshold": (float, lambda v: 0 <= v <= 255),
+    "frame_skip": (int, lambda v: v >= 1),
+    "sample_stride": (int, lambda v: v >= 1),
+    "frame_budget_ms": (float, lambda v: v >= 0),
+    "rate": (float, lambda v: v > 0),
+    "keepalive": (float, lambda v: v > 0.1),
+    "smoothing": (float, lambda v: v >= 0),
+    "capture_size": (_size, lambda v: True),
+    "crop": (_crop, lambda v: True),
+    "single_light": (_bool, lambda v: True),
+}
+
+
+def settings_from_message(payload):
+    """The settings in a message of the subscribed topic: a JSON object, or a shadow
+    document whose `state.desired` (or `state`) holds them, optionally under "harmonize"."""
+    doc = json.loads(payload)
+    if not isinstance(doc, dict):
+        raise ValueError("expected a JSON object")
+    if isinstance(doc.get("state"), dict):
+        doc = doc["state"].get("desired", doc["state"])
+    if isinstance(doc.get("harmonize"), dict):
+        doc = doc["harmonize"]
+    return doc
+
+
+class RuntimeConfig:
+    """Typed settings shared by the running stages, replaced as a whole.
+
+    `snapshot` is a (version, values) tuple whose dict is never modified.
+    `apply` converts and checks every item of a change first, rejecting the whole
+    change if one is invalid or its crop does not fit in the capture size (the
+    `capture_size` setting, else `frame_size` once the capture stage set it),
+    then swaps in a new snapshot, so a stage reading
+    `snapshot` once per frame sees all of a change or none of it, never blocks
+    and is never blocked. Stages notice a change by its version.
+    """
+
+    def __init__(self, **values):
+        self.lock = threading.Lock()
+        self.snapshot = (0, self.parse(values)[0])
+        self.frame_size = None  # (width, height) the capture device delivers
+        self.applied = 0
+        self.rejected = 0
+
+    @property
+    def version(self):
+        return self.snapshot[0]
+
+    def __getitem__(self, name):
+        return self.snapshot[1][name]
+
+    @staticmethod
+    def parse(changes):
+        """Returns ({name: typed value}, [unknown names]). Raises ValueError naming every invalid item."""
+        typed, unknown, errors = {}, [], []
+        for name, value in changes.items():
+            if name not in FIELDS:
+                unknown.append(name)
+                continue
+            kind, check = FIELDS[name]
+            try:
+                value = kind(value)
+                if not check(value):
+                    raise ValueError("out of range")
+            except (TypeError, ValueError) as e:
+                errors.append("{}={!r} ({})".format(name, value, e))
+                continue
+            typed[name] = value
+        if errors:
+            raise ValueError(", ".join(errors))
+        return typed, unknown
+
+    def apply(self, changes):
+        """Applies the known items of `changes` at once. Returns {name: value} of those that changed."""
+        try:
+            typed, _ = self.parse(changes)
+        except ValueError:
+            self.rejected += 1
+            raise
+        with self.lock:
+            version, values = self.snapshot
+            changed = {k: v for k, v in typed.items() if values.get(k) != v}
+            if "crop" in changed or "capture_size" in changed:
+                merged = dict(values, **changed)
+                size = merged.get("capture_size")
+                try:
+                    _check_crop(merged.get("crop"), tuple(int(v) for v in size.split("x")) if size else self.frame_size)
+                except ValueError:
+                    self.rejected += 1
+                    raise
+            if changed:
+                self.snapshot = (version + 1, dict(values, **changed))
+                self.applied += 1
+        return changed
+
+    def stats(self):
+        return {"version": self.version, "applied": self.applied, "rejected": self.rejected}
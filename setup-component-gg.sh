@@ -48,6 +48,7 @@ uri=s3://$artifact_bucket_name/artifacts/$component_name/$component_version/$com
 script="python3 -m pip install awsiotsdk; python3 -u {artifacts:decompressedPath}/$component_name/harmonize.py"
 topic="\$aws/things/$corename/shadow/name/tv"
 topic2="$topic/update/accepted"
+statstopic="harmonize/$corename/stats"
 json=$(jq --null-input \
   --arg component_name "$component_name" \
   --arg component_version "$component_version" \
@@ -55,6 +56,7 @@ json=$(jq --null-input \
   --arg uri "$uri" \
   --arg topic "$topic" \
   --arg topic2 "$topic2" \
+  --arg statstopic "$statstopic" \
 '{ "RecipeFormatVersion": "2020-01-25", 
 "ComponentName": $component_name, 
 "ComponentVersion": $component_version, 
@@ -86,9 +88,21 @@ json=$(jq --null-input \
                         $topic2
                     ]
                 }
+            },
+            "aws.greengrass.ipc.pubsub": {
+                "<component_name>:pubsub:1": {
+                    "policyDescription": "Allows publishing latency statistics",
+                    "operations": [
+                    "aws.greengrass#PublishToTopic"
+                    ],
+                    "resources": [
+                        $statstopic
+                    ]
+                }
             }
         },
-        "SubscribeToTopic": $topic2
+        "SubscribeToTopic": $topic2,
+        "StatsTopic": $statstopic
     }
 },
 "Manifests": [ { "Platform": { "os": "linux" }, 
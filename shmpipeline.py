@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory transport for running capture, analysis and sending in separate
+processes, so the Python parts of each stage get their own core instead of
+sharing one interpreter lock.
+"""
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import framesync
+
+WRITING = -1
+
+
+class SharedFrameRing:
+    """Ring of preallocated frame buffers in one shared memory block.
+
+    The capture process fills `next_buffer()` (e.g. with `cap.retrieve(image=...)`)
+    and calls `publish`; the analysis process uses `wait` exactly like
+    framesync.FrameSlot and gets a NumPy view into shared memory, so frames are
+    never copied between processes. Every slot carries the sequence number of the
+    frame it holds (WRITING while it is being filled) and its grab time;
+    `valid(seq)` tells a reader whether its frame was overwritten while it was
+    being analysed, which is counted as torn.
+    """
+
+    def __init__(self, cond, shape, dtype, slots=3, name=None, video_size=None):
+        self.cond = cond
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.video_size = video_size
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        header_bytes = 8 * (1 + 2 * slots)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=header_bytes + slots * frame_bytes)
+            self.owner = True
+        else:
+            # Stages are forked, so they share one resource tracker and the
+            # registration made here is dropped again by the owner's unlink.
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.header = np.ndarray((1 + slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.stamps = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf, offset=8 * (1 + slots))
+        self.frames = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=header_bytes)
+        if self.owner:
+            self.header[:] = 0
+            self.stamps[:] = 0
+        self.skipped = 0
+        self.consumed = 0
+        self.torn = 0
+
+    def descriptor(self):
+        """What another process needs to `attach` to this ring."""
+        return {"name": self.shm.name, "shape": self.shape, "dtype": self.dtype.str,
+                "slots": self.slots, "video_size": self.video_size}
+
+    @classmethod
+    def attach(cls, cond, descriptor):
+        return cls(cond, descriptor["shape"], descriptor["dtype"], descriptor["slots"],
+                   name=descriptor["name"], video_size=descriptor["video_size"])
+
+    @property
+    def seq(self):
+        return int(self.header[0])
+
+    def next_buffer(self):
+        """Returns the slot the next frame goes into and marks it as being written."""
+        idx = (self.seq + 1) % self.slots
+        with self.cond:
+            self.header[1 + idx] = WRITING
+        return self.frames[idx]
+
+    def publish(self, frame, stamp=0):
+        """Commits the next frame, grabbed at `stamp` (time.monotonic_ns()), copying it in
+        unless it was written into `next_buffer()`."""
+        seq = self.seq + 1
+        idx = seq % self.slots
+        if not np.shares_memory(frame, self.frames[idx]):
+            with self.cond:
+                self.header[1 + idx] = WRITING
+            self.frames[idx] = frame.reshape(self.shape)
+        with self.cond:
+            self.stamps[idx] = stamp
+            self.header[1 + idx] = seq
+            self.header[0] = seq
+            self.cond.notify_all()
+        return seq
+
+    def wait(self, last_seq, timeout=None):
+        """Blocks until a frame newer than `last_seq` is available.
+        Returns (seq, frame view), or (last_seq, None) if `timeout` expires first."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.header[0] > last_seq, timeout):
+                return last_seq, None
+            seq = int(self.header[0])
+        if last_seq:
+            self.skipped += seq - last_seq - 1
+        self.consumed += 1
+        return seq, self.frames[seq % self.slots]
+
+    def stamp_of(self, seq):
+        """Grab time of frame `seq`, meaningful while `valid(seq)`."""
+        return int(self.stamps[seq % self.slots])
+
+    def valid(self, seq):
+        """True if the frame `seq` is still intact in its slot; counts it as torn otherwise."""
+        if self.header[1 + seq % self.slots] == seq:
+            return True
+        self.torn += 1
+        return False
+
+    def stats(self):
+        return {"published": self.seq, "consumed": self.consumed,
+                "skipped": self.skipped, "torn": self.torn}
+
+    def close(self):
+        self.header = self.stamps = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingPublisher:
+    """Capture-side stand-in for framesync.FrameSlot that creates the SharedFrameRing
+    once the first frame shows its shape, then sends the ring's descriptor to the
+    analysis process through `queue`."""
+
+    def __init__(self, cond, queue, slots=3):
+        self.cond = cond
+        self.queue = queue
+        self.slots = slots
+        self.ring = None
+        self.video_size = None
+
+    def next_buffer(self):
+        return None if self.ring is None else self.ring.next_buffer()
+
+    def publish(self, frame, stamp=0):
+        if self.ring is None:
+            self.ring = SharedFrameRing(self.cond, frame.shape, frame.dtype, self.slots, video_size=self.video_size)
+            self.queue.put(self.ring.descriptor())
+        return self.ring.publish(frame, stamp)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+
+
+class SharedColors:
+    """Per-light 16-bit target colors handed from the analysis process to the sender.
+
+    The analysis side writes into the process-local `target` array (same interface
+    as huestream.ColorSmoother) and `mark` publishes it as a framesync.ColorSnapshot
+    in shared memory, without a lock, then wakes the sender; the sending side calls
+    `wait` and `read`, which copies the newest whole snapshot and returns the grab
+    time of the frame the colors came from. `cond` only carries the wake-ups.
+    Create it before forking so both processes share the mapping.
+    """
+
+    def __init__(self, cond, lights):
+        self.cond = cond
+        self.shm = shared_memory.SharedMemory(create=True, size=framesync.ColorSnapshot.nbytes(lights))
+        self.shm.buf[:framesync.ColorSnapshot.HEADER] = bytes(framesync.ColorSnapshot.HEADER)
+        self.snapshot = framesync.ColorSnapshot(lights, self.shm.buf)
+        self.target = np.zeros((lights, 3))
+
+    def set_rgb8(self, rgb, rows=slice(None)):
+        self.target[rows] = np.asarray(rgb, dtype=np.float64) * 257
+
+    def mark(self, stamp=None):
+        self.snapshot.publish(self.target, time.monotonic_ns() if stamp is None else stamp)
+        with self.cond:
+            self.cond.notify_all()
+
+    def notify(self):
+        pass  # `mark` already woke the sender
+
+    def wait(self, last_seq, timeout=None):
+        """Blocks until colors newer than `last_seq` arrive. Returns the new sequence number."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.snapshot.seq > last_seq, timeout)
+        return self.snapshot.seq
+
+    def read(self, out):
+        """Copies the newest colors into `out` and returns the grab time they came from."""
+        return self.snapshot.read(out)[1]
+
+    def stats(self):
+        return self.snapshot.stats()
+
+    def close(self, unlink=True):
+        self.snapshot = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Cancellation tokens and a supervisor that keeps the pipeline stages running.
+"""
+import threading
+import time
+
+
+class CancelToken:
+    """Cooperative cancellation flag. Stages poll `cancelled` or sleep in `wait`,
+    which returns early (True) once the token is cancelled. Cancelling a token
+    also cancels every token made from it with `child`."""
+
+    def __init__(self, parent=None):
+        self.event = threading.Event()
+        self.parent = parent
+        self.children = set()
+        self.lock = threading.Lock()
+        if parent is not None:
+            parent._attach(self)
+
+    def _attach(self, child):
+        with self.lock:
+            if not self.event.is_set():
+                self.children.add(child)
+                return
+        child.cancel()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            children, self.children = self.children, set()
+        for child in children:
+            child.cancel()
+
+    def wait(self, timeout=None):
+        """Sleeps until cancelled or `timeout` seconds passed. Returns True if cancelled."""
+        return self.event.wait(timeout)
+
+    def child(self):
+        return CancelToken(self)
+
+    def detach(self):
+        """Stops following the parent, so finished tokens do not pile up in it."""
+        if self.parent is not None:
+            with self.parent.lock:
+                self.parent.children.discard(self)
+
+
+class Supervisor:
+    """Runs each stage, a function taking a CancelToken, in its own thread.
+
+    A stage that raises, or returns while not cancelled, is logged and run again
+    in the same thread after a backoff (doubling from `backoff` up to
+    `max_backoff`, reset once a run lasted a minute), so a failed stage is
+    restarted on its own while the others keep running. `restart(name)` cancels
+    one stage's token to have it restarted at once. `stop` cancels everything
+    and waits at most `timeout` seconds in total for the threads to end.
+    """
+
+    def __init__(self, token, log=print, backoff=1.0, max_backoff=30.0):
+        self.token = token
+        self.log = log
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stages = {}
+        self.tokens = {}
+        self.threads = {}
+        self.restarts = {}
+
+    def add(self, name, target, restart=True):
+        """Registers `target(token)` as stage `name`; with restart=False it runs only once."""
+        self.stages[name] = (target, restart)
+        self.tokens[name] = self.token.child()
+        self.restarts[name] = 0
+
+    def start(self, name=None):
+        """Starts the thread of stage `name`, or of every stage not started yet."""
+        for n in [name] if name else list(self.stages):
+            if n in self.threads:
+                continue
+            t = threading.Thread(target=self._run, args=(n,), name=n, daemon=True)
+            self.threads[n] = t
+            t.start()
+
+    def _run(self, name):
+        target, restart = self.stages[name]
+        backoff = self.backoff
+        while not self.token.cancelled:
+            token = self.tokens[name]
+            started = time.monotonic()
+            try:
+                target(token)
+                reason = None
+            except (Exception, SystemExit) as e:  # sys.exit() in a stage thread would end it silently
+                reason = "failed: {!r}".format(e)
+            if self.token.cancelled:
+                break
+            if token.cancelled:  # restart(name) asked for a fresh run
+                token.detach()
+                self.tokens[name] = self.token.child()
+                self.restarts[name] += 1
+                continue
+            if not restart:  # one-off stage, only failures are worth reporting
+                if reason:
+                    self.log("Stage {} {}".format(name, reason))
+                break
+            if time.monotonic() - started > 60:
+                backoff = self.backoff
+            self.log("Stage {} {}, restarting in {:g} s".format(name, reason or "stopped", backoff))
+            if self.token.wait(backoff):
+                break
+            backoff = min(backoff * 2, self.max_backoff)
+            self.restarts[name] += 1
+        self.tokens[name].detach()
+
+    def restart(self, name):
+        self.tokens[name].cancel()
+
+    def stop(self, timeout=5):
+        """Cancels all stages and joins them within `timeout` seconds. Returns the names of stages still running."""
+        self.token.cancel()
+        deadline = time.monotonic() + timeout
+        for t in self.threads.values():
+            t.join(max(deadline - time.monotonic(), 0))
+        return [name for name, t in self.threads.items() if t.is_alive()]
+
+    def stats(self):
+        return {"alive": [n for n, t in self.threads.items() if t.is_alive()], "restarts": dict(self.restarts)}
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""
+Exercises telemetry.TelemetryPublisher against a fake IPC client, no Greengrass
+or awsiot needed: batching, the last batch sent by close, dropping when full
+and publishes that time out. Exits with 1 if a check fails.
+
+    python3 telemetrytest.py
+"""
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import telemetry
+
+
+class FakeClient:
+    """Stands in for GreengrassCoreIPCClient: keeps every published (topic, batch)
+    and completes each publish after `delay` seconds."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.messages = []
+
+    def new_publish_to_topic(self):
+        return FakeOperation(self)
+
+
+class FakeOperation:
+
+    def __init__(self, client):
+        self.client = client
+        self.response = Future()
+
+    def activate(self, request):
+        def complete():
+            time.sleep(self.client.delay)
+            self.client.messages.append(request)
+            self.response.set_result(None)
+        threading.Thread(target=complete, daemon=True).start()
+
+    def get_response(self):
+        return self.response
+
+
+def fake_request(topic, batch):
+    return topic, batch
+
+
+def publisher(client, **kwargs):
+    return telemetry.TelemetryPublisher(client, "stats", request=fake_request, **kwargs)
+
+
+def main():
+    logging.basicConfig()
+    failed = []
+
+    def check(name, ok):
+        print("{} {}".format("ok  " if ok else "FAIL", name))
+        if not ok:
+            failed.append(name)
+
+    client = FakeClient()
+    stats = publisher(client, interval=0.2)
+    stats.publish("fps", 29)
+    stats.update({"fps": 30, "dropped": 1})
+    time.sleep(0.5)
+    check("one batch per interval", len(client.messages) == 1)
+    topic, message = client.messages[0] if client.messages else (None, {})
+    check("batch holds the newest value of each key", topic == "stats" and message.get("fps") == 30 and message.get("dropped") == 1)
+    check("repeated key coalesced", message.get("telemetry", {}).get("coalesced") == 1)
+    stats.publish("fps", 31)
+    stats.close(timeout=2)
+    check("close publishes the last batch", len(client.messages) == 2 and client.messages[-1][1].get("fps") == 31)
+    check("publisher thread stopped", not stats.thread.is_alive())
+
+    client = FakeClient(delay=0.5)
+    stats = publisher(client, interval=60, max_pending=2, timeout=2)
+    started = time.monotonic()
+    for n in range(3):
+        stats.publish("metric{}".format(n), n)
+    check("publish does not wait on a slow client", time.monotonic() - started < 0.1)
+    check("oldest dropped when full", stats.dropped == 1 and list(stats.pending) == ["metric1", "metric2"])
+    stats.close(timeout=2)
+    message = client.messages[-1][1] if client.messages else {}
+    check("last batch carries the drop count", "metric0" not in message and message.get("telemetry", {}).get("dropped") == 1)
+
+    stats = publisher(FakeClient(delay=1), interval=60, timeout=0.1)
+    stats.publish("fps", 30)
+    stats.close(timeout=2)
+    check("batch outlasting the timeout counted as failed", stats.failed == 1 and stats.published == 0)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()